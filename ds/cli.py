@@ -1,7 +1,9 @@
+import os
 import sys
 import asyncio
 import logging.handlers
 import signal
+import time
 from configparser import ConfigParser
 
 import click
@@ -14,7 +16,9 @@ from sqlalchemy.dialects import postgresql as pg
 import aiopg.sa
 
 from . import db
+from .db import transfer
 from .dhcp.server import DHCPServer, DBChannelListener
+from .dhcp.admission import Admission
 from .web.server import WebServer
 
 
@@ -50,18 +54,68 @@ def config_logging(config, log_level=None):
         root_logger.addHandler(handler)
 
 
+DB_POOL_OPTIONS = ('minsize', 'maxsize')
+
+
+def config_db_params(config):
+    return {key: value for key, value in config['database'].items() if key not in DB_POOL_OPTIONS}
+
+
 async def config_db(config):
     db_engine = await aiopg.sa.create_engine(
-        **config['database'])
+        minsize=config.getint('database', 'minsize', fallback=1),
+        maxsize=config.getint('database', 'maxsize', fallback=10),
+        **config_db_params(config))
     return db_engine
 
 
 @click.command()
 @click.option('-c', '--config', 'config_file', required=True, type=click.Path(exists=True, dir_okay=False))
 @click.option('-l', '--log-level', 'log_level')
-def dhcp_server(config_file, log_level):
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1))
+def dhcp_server(config_file, log_level, workers):
     config = config_load(config_file)
     config_logging(config, log_level)
+
+    if workers > 1:
+        from .dhcp.supervisor import Supervisor
+        supervisor = Supervisor(workers, lambda idx: dhcp_server_run(config, reuse_port=True, worker=idx))
+        supervisor.run()
+    else:
+        dhcp_server_run(config)
+
+
+def config_admission(config):
+    params = {
+        'relay_rate': config.getfloat('dhcp', 'relay_rate', fallback=0),
+        'relay_burst': config.getfloat('dhcp', 'relay_burst', fallback=None),
+        'mac_rate': config.getfloat('dhcp', 'mac_rate', fallback=0),
+        'mac_burst': config.getfloat('dhcp', 'mac_burst', fallback=None),
+        'max_backlog': config.getint('dhcp', 'max_backlog', fallback=0),
+    }
+    if not (params['relay_rate'] or params['mac_rate'] or params['max_backlog']):
+        return None
+    return Admission(**params)
+
+
+def worker_journal_dir(journal_dir, worker):
+    ''' У каждого воркера свой каталог журнала: сегменты одного каталога пишет и проигрывает
+    только один процесс.
+    '''
+    if journal_dir is None or worker is None:
+        return journal_dir
+    return os.path.join(journal_dir, 'w{:d}'.format(worker))
+
+
+def worker_snapshot_file(snapshot_file, worker):
+    ''' Снимок кэша на воркер: /opt/ds/dhcp-cache.snap -> /opt/ds/dhcp-cache.w0.snap. '''
+    if snapshot_file is None or worker is None:
+        return snapshot_file
+    root, ext = os.path.splitext(snapshot_file)
+    return '{}.w{:d}{}'.format(root, worker, ext)
+
+
+def dhcp_server_run(config, reuse_port=False, worker=None):
     logger = logging.getLogger(__name__)
 
     loop = asyncio.get_event_loop()
@@ -73,20 +127,55 @@ def dhcp_server(config_file, log_level):
 
     logger.info('Init db connection...')
     db_engine = loop.run_until_complete(config_db(config))
-    channel = DBChannelListener(config['database'], 'dhcp_control')
+    channel = DBChannelListener(
+        config_db_params(config), db.CONTROL_CHANNEL,
+        keepalive=config.getfloat('dhcp', 'channel_keepalive', fallback=10), loop=loop)
     loop.run_until_complete(channel.start())
     logger.info('Init dhcp server...')
-    server = DHCPServer(db_engine, channel, config.get('dhcp', 'default_server_addr', fallback=None))
-
-    loop.run_until_complete(server.db_load_owners())
+    server = DHCPServer(
+        db_engine, channel, config.get('dhcp', 'default_server_addr', fallback=None),
+        stats_interval=config.getfloat('dhcp', 'stats_interval', fallback=60),
+        load_chunk=config.getint('dhcp', 'load_chunk', fallback=5000),
+        snapshot_file=worker_snapshot_file(config.get('dhcp', 'snapshot_file', fallback=None), worker),
+        snapshot_interval=config.getfloat('dhcp', 'snapshot_interval', fallback=300),
+        snapshot_max_age=config.getfloat('dhcp', 'snapshot_max_age', fallback=86400),
+        lease_flush_size=config.getint('dhcp', 'lease_flush_size', fallback=500),
+        lease_flush_interval=config.getfloat('dhcp', 'lease_flush_interval', fallback=0.5),
+        staging_flush_size=config.getint('dhcp', 'staging_flush_size', fallback=200),
+        staging_flush_interval=config.getfloat('dhcp', 'staging_flush_interval', fallback=0.2),
+        staging_ttl=config.getfloat('dhcp', 'staging_ttl', fallback=600),
+        lease_refresh=config.getfloat('dhcp', 'lease_refresh', fallback=0.5),
+        db_workers=config.getint('dhcp', 'db_workers', fallback=2),
+        db_queue_size=config.getint('dhcp', 'db_queue_size', fallback=1000),
+        journal_dir=worker_journal_dir(config.get('dhcp', 'journal_dir', fallback=None), worker),
+        journal_fsync_interval=config.getfloat('dhcp', 'journal_fsync_interval', fallback=0.2),
+        journal_replay_interval=config.getfloat('dhcp', 'journal_replay_interval', fallback=5),
+        reconcile_interval=config.getfloat('dhcp', 'reconcile_interval', fallback=300),
+        reload_debounce=config.getfloat('dhcp', 'reload_debounce', fallback=0.05),
+        reply_cache_size=config.getint('dhcp', 'reply_cache_size', fallback=4096),
+        reply_cache_ttl=config.getfloat('dhcp', 'reply_cache_ttl', fallback=3),
+        admission=config_admission(config))
+
+    if config.getboolean('dhcp', 'background_load', fallback=False):
+        # отвечаем из частичного кэша, пока он загружается
+        def on_loaded(future):
+            if not future.cancelled() and future.exception():
+                logger.error('cache loading failed: %s', future.exception())
+                loop.stop()
+        future = asyncio.ensure_future(server.db_warm_up(), loop=loop)
+        future.add_done_callback(on_loaded)
+    else:
+        loop.run_until_complete(server.db_warm_up())
 
+    recv_batch = config.getint('dhcp', 'recv_batch', fallback=64)
+    send_queue = config.getint('dhcp', 'send_queue', fallback=256)
     binds = config.get('dhcp', 'binds').split()
     for bind in binds:
         if ':' in bind:
             host, port = bind.split(':')
         else:
             host, port = bind, 67
-        server.bind(host, port=port)
+        server.bind(host, port=port, recv_batch=recv_batch, wqueue=send_queue, reuse_port=reuse_port)
 
     logger.info('Starting main loop...')
     try:
@@ -163,12 +252,167 @@ def cli_db():
 def cli_db_init(ctx):
     cfg = ctx.obj['cfg']
     db_conn_format = 'postgresql://{user}:{password}@{host}:{port}/{database}'
-    db_uri = db_conn_format.format(**cfg['database'])
+    db_uri = db_conn_format.format(**config_db_params(cfg))
     engine = sa.create_engine(db_uri)
     with engine.connect() as conn:
         db.metadata.create_all(conn)
 
 
+@cli_db.command('upgrade')
+@click.pass_context
+def cli_db_upgrade(ctx):
+    cfg = ctx.obj['cfg']
+    db_conn_format = 'postgresql://{user}:{password}@{host}:{port}/{database}'
+    db_uri = db_conn_format.format(**config_db_params(cfg))
+    engine = sa.create_engine(db_uri)
+    with engine.begin() as conn:
+        db.upgrade(conn)
+
+
+@cli_db.command('reconcile-usage')
+@click.pass_context
+def cli_db_reconcile_usage(ctx):
+    cfg = ctx.obj['cfg']
+    db_conn_format = 'postgresql://{user}:{password}@{host}:{port}/{database}'
+    db_uri = db_conn_format.format(**config_db_params(cfg))
+    engine = sa.create_engine(db_uri)
+    with engine.begin() as conn:
+        fixed = db.reconcile_usage(conn)
+    click.echo('fixed counters of {} profiles{}'.format(
+        len(fixed), ': ' + ', '.join(map(str, fixed)) if fixed else ''))
+
+
+def transfer_format(fmt, filename):
+    if fmt is not None:
+        return fmt
+    for name in transfer.FORMATS:
+        if filename.endswith('.' + name):
+            return name
+    return 'ndjson'
+
+
+@cli_db.command('export')
+@click.argument('kind', type=click.Choice(sorted(transfer.FIELDS)))
+@click.option('-f', '--format', 'fmt', type=click.Choice(transfer.FORMATS), help='default: by file extension')
+@click.option('-o', '--output', type=click.File('w', encoding='utf-8'), default='-')
+@click.pass_context
+def cli_db_export(ctx, kind, fmt, output):
+    cfg = ctx.obj['cfg']
+    fmt = transfer_format(fmt, output.name)
+
+    async def write(text):
+        output.write(text)
+
+    async def run():
+        engine = await config_db(cfg)
+        async with engine.acquire() as conn:
+            count = await transfer.export(conn, kind, fmt, write)
+        engine.close()
+        await engine.wait_closed()
+        click.echo('exported {} {}'.format(count, kind), err=True)
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+@cli_db.command('import')
+@click.argument('kind', type=click.Choice(sorted(transfer.FIELDS)))
+@click.argument('input', type=click.File('r', encoding='utf-8'))
+@click.option('-f', '--format', 'fmt', type=click.Choice(transfer.FORMATS), help='default: by file extension')
+@click.pass_context
+def cli_db_import(ctx, kind, input, fmt):
+    ''' Загружает файл через COPY во временную таблицу и сливает с основной одной транзакцией,
+    после чего DHCP серверы получают одну команду RESYNC.
+    '''
+    cfg = ctx.obj['cfg']
+    fmt = transfer_format(fmt, input.name)
+    db_conn_format = 'postgresql://{user}:{password}@{host}:{port}/{database}'
+    db_uri = db_conn_format.format(**config_db_params(cfg))
+    engine = sa.create_engine(db_uri)
+    try:
+        with engine.begin() as conn:
+            since = conn.scalar(sa.select([sa.func.now()]))
+            conn.execute(transfer.staging_table_sql(kind))
+            loaded = transfer.copy_records(
+                conn.connection.cursor(), kind, transfer.read_records(fmt, kind, input))
+            merged = conn.execute(transfer.merge_sql(kind)).fetchall()
+            conn.execute(db.resync_notification(since))
+    except transfer.TransferError as e:
+        raise click.ClickException(str(e))
+    total = sum(row.merged for row in merged)
+    click.echo('loaded {} records, merged {} into {} profiles, skipped {}'.format(
+        loaded, total, len(merged), loaded - total))
+
+
+@cli_db.command('assign-staging')
+@click.option('-p', '--profile-id', required=True, type=int)
+@click.option('-i', '--id', 'ids', multiple=True, type=int, help='assign only these staged owners')
+@click.pass_context
+def cli_db_assign_staging(ctx, profile_id, ids):
+    cfg = ctx.obj['cfg']
+
+    async def run():
+        engine = await config_db(cfg)
+        async with engine.acquire() as conn:
+            async with conn.begin():
+                assigned = await db.assign_staging(conn, profile_id, ids)
+        engine.close()
+        await engine.wait_closed()
+        click.echo('assigned {} addresses'.format(len(assigned)))
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+@cli_db.command('alloc-bench')
+@click.option('-p', '--profile-id', required=True, type=int)
+@click.option('-n', '--count', default=100, type=click.IntRange(min=1))
+@click.pass_context
+def cli_db_alloc_bench(ctx, profile_id, count):
+    ''' Сравнивает поиск свободного адреса запросом generate_series/EXCEPT и битовой картой.
+    Ничего не записывает: выделения делаются в транзакции, которая откатывается.
+    '''
+    from .web.allocator import AddressAllocator
+
+    cfg = ctx.obj['cfg']
+    gen = sa.select([
+        (sa.cast('0.0.0.0', pg.INET) + sa.func.generate_series(
+            sa.cast(db.profile.c.network_addr, pg.INET) - '0.0.0.0' + 1,
+            sa.func.broadcast(db.profile.c.network_addr) - '0.0.0.0' - 1
+        )).label('ip_addr')
+    ]).where(db.profile.c.id == profile_id)
+    sel = sa.select([db.owner.c.ip_addr]). \
+        where(db.owner.c.profile_id == profile_id). \
+        where(db.owner.c.ip_addr != None)
+    query = gen.except_(sel).order_by('ip_addr').limit(1)
+
+    async def run():
+        engine = await config_db(cfg)
+        async with engine.acquire() as conn:
+            started = time.monotonic()
+            for _ in range(count):
+                await conn.scalar(query)
+            query_ms = (time.monotonic() - started) * 1000 / count
+
+            allocator = AddressAllocator()
+            tr = await conn.begin()
+            try:
+                started = time.monotonic()
+                allocator.mark(profile_id, await allocator.allocate(conn, profile_id))
+                first_ms = (time.monotonic() - started) * 1000
+                started = time.monotonic()
+                for _ in range(count - 1):
+                    # без отметки следующий поиск вернул бы тот же адрес
+                    allocator.mark(profile_id, await allocator.allocate(conn, profile_id))
+                next_ms = (time.monotonic() - started) * 1000 / max(1, count - 1)
+            finally:
+                await tr.rollback()
+        engine.close()
+        await engine.wait_closed()
+        click.echo('generate_series/EXCEPT: {:.2f} ms per lookup'.format(query_ms))
+        click.echo('bitmap: {:.2f} ms first (builds the map), {:.2f} ms per next lookup'.format(first_ms, next_ms))
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
 @cli.command('dhcp-bench')
 @click.option('-T', '--threads', default=1)
 @click.option('-1', '--oneshot', default=False, is_flag=True)
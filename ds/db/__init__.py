@@ -75,7 +75,7 @@ owner = sa.Table(
     sa.Column('create_date', sa.DateTime(timezone=True), nullable=False,
               server_default=sa.func.now()),
     sa.Column('modify_date', sa.DateTime(timezone=True), nullable=False,
-              server_default=sa.func.now()),
+              server_default=sa.func.now(), index=True),
     sa.Column('lease_date', sa.DateTime(timezone=True), nullable=False,
               server_default=sa.func.now()),
     sa.Column('profile_id', sa.Integer, sa.ForeignKey('profile.id', ondelete='CASCADE'),
@@ -86,3 +86,205 @@ owner = sa.Table(
     sa.UniqueConstraint('profile_id', 'ip_addr'),
     sa.UniqueConstraint('profile_id', 'mac_addr'),
 )
+
+# постраничный вывод списков по (дата, id): ожидающие MAC по create_date, назначенные
+# по lease_date; частичные индексы совпадают с условием страницы, и её чтение
+# не проходит строки другого списка
+_staged = owner.c.ip_addr.is_(None)
+_assigned = owner.c.ip_addr.isnot(None)
+sa.Index('ix_owner_assigned_lease_date_id', owner.c.lease_date, owner.c.id, postgresql_where=_assigned)
+sa.Index('ix_owner_staged_create_date_id', owner.c.create_date, owner.c.id, postgresql_where=_staged)
+# то же с фильтром по профилю
+sa.Index('ix_owner_profile_assigned_lease_date_id', owner.c.profile_id, owner.c.lease_date, owner.c.id,
+         postgresql_where=_assigned)
+sa.Index('ix_owner_profile_staged_create_date_id', owner.c.profile_id, owner.c.create_date, owner.c.id,
+         postgresql_where=_staged)
+# фильтр по диапазону IP
+sa.Index('ix_owner_ip_addr', owner.c.ip_addr)
+
+# удалённые строки owner, пополняется триггером; DHCP сервер читает их по watermark
+# вместо сверки всей таблицы с кэшем
+owner_deleted = sa.Table(
+    'owner_deleted', metadata,
+    sa.Column('id', sa.BigInteger, primary_key=True),
+    sa.Column('delete_date', sa.DateTime(timezone=True), nullable=False,
+              server_default=sa.func.now(), index=True),
+    sa.Column('owner_id', sa.Integer, nullable=False),
+    sa.Column('profile_id', sa.Integer, nullable=False),
+    sa.Column('mac_addr', pg.MACADDR, nullable=True),
+)
+
+_sql_owner_deleted_trigger = '''
+CREATE OR REPLACE FUNCTION owner_deleted_log() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO owner_deleted (owner_id, profile_id, mac_addr) VALUES (OLD.id, OLD.profile_id, OLD.mac_addr);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS owner_deleted_log ON owner;
+CREATE TRIGGER owner_deleted_log AFTER DELETE ON owner
+    FOR EACH ROW EXECUTE PROCEDURE owner_deleted_log();
+'''
+
+# число владельцев профиля, поддерживается триггером на owner
+profile_usage = sa.Table(
+    'profile_usage', metadata,
+    sa.Column('profile_id', sa.Integer, sa.ForeignKey('profile.id', ondelete='CASCADE'),
+              primary_key=True),
+    sa.Column('assigned', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('staged', sa.Integer, nullable=False, server_default='0'),
+)
+
+# Строка счётчиков блокируется до конца транзакции, поэтому пачки, затрагивающие несколько
+# профилей, должны изменять владельцев в порядке id профиля. UPDATE, не задающие profile_id
+# и ip_addr (продление аренды пачкой), триггер не вызывают вовсе; изменения, которые задают
+# их, но не меняют профиль и наличие адреса (правка из веб-интерфейса), счётчики не трогают.
+_sql_profile_usage_trigger = '''
+CREATE OR REPLACE FUNCTION profile_usage_count() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND NEW.profile_id = OLD.profile_id
+            AND (NEW.ip_addr IS NULL) = (OLD.ip_addr IS NULL) THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE profile_usage SET
+            assigned = assigned - (OLD.ip_addr IS NOT NULL)::int,
+            staged = staged - (OLD.ip_addr IS NULL)::int
+        WHERE profile_id = OLD.profile_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO profile_usage AS u (profile_id, assigned, staged)
+        VALUES (NEW.profile_id, (NEW.ip_addr IS NOT NULL)::int, (NEW.ip_addr IS NULL)::int)
+        ON CONFLICT (profile_id) DO UPDATE SET
+            assigned = u.assigned + EXCLUDED.assigned,
+            staged = u.staged + EXCLUDED.staged;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS owner_profile_usage ON owner;
+CREATE TRIGGER owner_profile_usage AFTER INSERT OR DELETE OR UPDATE OF profile_id, ip_addr ON owner
+    FOR EACH ROW EXECUTE PROCEDURE profile_usage_count();
+'''
+
+# create_all вызывается и из upgrade, поэтому DDL должен выполняться повторно без ошибок
+sa.event.listen(metadata, 'after_create', sa.DDL(_sql_profile_usage_trigger))
+sa.event.listen(metadata, 'after_create', sa.DDL(_sql_owner_deleted_trigger))
+
+# блокировка не пускает триггеры, пока счётчики пересчитываются по снимку таблицы; режим
+# конфликтует сам с собой, так что два пересчёта идут по очереди, а не взаимоблокируются
+# при переходе к записи
+_sql_reconcile_usage = sa.text(
+    'LOCK TABLE profile_usage IN SHARE ROW EXCLUSIVE MODE; '
+    'INSERT INTO profile_usage AS u (profile_id, assigned, staged) '
+    'SELECT profile.id, count(owner.ip_addr), count(owner.id) - count(owner.ip_addr) '
+    'FROM profile LEFT JOIN owner ON owner.profile_id = profile.id '
+    'GROUP BY profile.id '
+    'ON CONFLICT (profile_id) DO UPDATE SET assigned = EXCLUDED.assigned, staged = EXCLUDED.staged '
+    'WHERE (u.assigned, u.staged) IS DISTINCT FROM (EXCLUDED.assigned, EXCLUDED.staged) '
+    'RETURNING profile_id'
+)
+
+
+def reconcile_usage(conn):
+    ''' Пересчитывает счётчики profile_usage по таблице owner.
+    Возвращает id профилей, счётчики которых разошлись с таблицей. Вызывается внутри транзакции.
+    '''
+    return [row.profile_id for row in conn.execute(_sql_reconcile_usage).fetchall()]
+
+
+# индексы прежних версий схемы, заменённые частичными
+_obsolete_indexes = (
+    'ix_owner_lease_date_id', 'ix_owner_create_date_id',
+    'ix_owner_profile_lease_date_id', 'ix_owner_profile_create_date_id',
+)
+
+
+def upgrade(conn):
+    ''' Доводит схему существующей БД до metadata: создаёт недостающие таблицы и индексы,
+    удаляет устаревшие индексы и заполняет счётчики profile_usage.
+    '''
+    metadata.create_all(conn)
+    for name in _obsolete_indexes:
+        conn.execute('DROP INDEX IF EXISTS {}'.format(name))
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            ddl = str(sa.schema.CreateIndex(index).compile(dialect=conn.dialect))
+            conn.execute(ddl.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1))
+    reconcile_usage(conn)
+
+
+# канал управления DHCP сервером, команды вида "ДЕЙСТВИЕ значение,значение,..."
+CONTROL_CHANNEL = 'dhcp_control'
+# payload NOTIFY должен быть короче 8000 байт
+NOTIFY_PAYLOAD_LIMIT = 7999
+
+_sql_notify_many = sa.text('SELECT pg_notify(:channel, p) FROM unnest(CAST(:payloads AS text[])) AS p')
+
+
+def control_payloads(action, values, limit=NOTIFY_PAYLOAD_LIMIT):
+    ''' Разбивает команду со списком значений на payload'ы, каждый не длиннее limit байт. '''
+    chunk = []
+    size = len(action)
+    for value in map(str, values):
+        if chunk and size + 1 + len(value) > limit:
+            yield '{} {}'.format(action, ','.join(chunk))
+            chunk = []
+            size = len(action)
+        chunk.append(value)
+        size += 1 + len(value)
+    if chunk:
+        yield '{} {}'.format(action, ','.join(chunk))
+
+
+async def notify_control(conn, action, values):
+    ''' Отправляет команду DHCP серверу одним запросом, сколько бы payload'ов она ни заняла. '''
+    payloads = list(control_payloads(action, values))
+    if payloads:
+        await conn.execute(_sql_notify_many, channel=CONTROL_CHANNEL, payloads=payloads)
+
+
+def resync_notification(since):
+    ''' Запрос, сообщающий DHCP серверу о пакетном изменении: догрузить всё, что изменено после since.
+    Одна команда вместо перезагрузки каждой строки.
+    '''
+    return sa.select([sa.func.pg_notify(CONTROL_CHANNEL, 'RESYNC {:.6f}'.format(since.timestamp()))])
+
+
+# первый ключ pg_advisory_xact_lock(int, int) при выдаче адресов, второй — id профиля
+ADDRESS_LOCK_CLASS = 0x4453
+
+_sql_assign_staging = sa.text(
+    'WITH free AS ('
+    '  SELECT ip_addr, row_number() OVER (ORDER BY ip_addr) AS n FROM ('
+    '    SELECT CAST(\'0.0.0.0\' AS inet) + s AS ip_addr FROM profile, generate_series('
+    '      network_addr - \'0.0.0.0\' + 1, broadcast(network_addr) - \'0.0.0.0\' - 1) AS s '
+    '    WHERE profile.id = :profile_id '
+    '    EXCEPT '
+    '    SELECT ip_addr FROM owner WHERE profile_id = :profile_id AND ip_addr IS NOT NULL'
+    '  ) AS f'
+    '), staged AS ('
+    '  SELECT id, row_number() OVER (ORDER BY create_date, id) AS n FROM owner '
+    '  WHERE profile_id = :profile_id AND ip_addr IS NULL '
+    '  AND (CAST(:ids AS integer[]) IS NULL OR id = ANY(CAST(:ids AS integer[])))'
+    ') '
+    'UPDATE owner SET ip_addr = free.ip_addr, modify_date = now() '
+    'FROM staged JOIN free USING (n) '
+    'WHERE owner.id = staged.id '
+    'RETURNING owner.id'
+)
+
+
+async def assign_staging(conn, profile_id, ids=None):
+    ''' Назначает свободные адреса всем ожидающим привязки владельцам профиля (или только ids)
+    одним запросом и отправляет DHCP серверу одну команду перезагрузки.
+    Возвращает список id получивших адрес; тем, кому адреса не хватило, ничего не назначается.
+    Вызывается внутри транзакции.
+    '''
+    await conn.execute(sa.select([sa.func.pg_advisory_xact_lock(ADDRESS_LOCK_CLASS, profile_id)]))
+    res = await conn.execute(_sql_assign_staging, profile_id=profile_id, ids=list(ids) if ids else None)
+    assigned = [row.id for row in await res.fetchall()]
+    await notify_control(conn, 'RELOAD_ITEMS', assigned)
+    return assigned
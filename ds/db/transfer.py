@@ -0,0 +1,239 @@
+''' Выгрузка и загрузка профилей и владельцев в форматах NDJSON и CSV.
+
+Выгрузка читает таблицу серверным курсором порциями по EXPORT_CHUNK строк, так что память
+не зависит от размера таблицы. Загрузка складывает записи во временную таблицу (COPY из ds-cli,
+пачками INSERT из веб-интерфейса — aiopg не умеет COPY) и затем переносит их в основную
+таблицу одним INSERT ... ON CONFLICT. Значения передаются текстом в представлении PostgreSQL,
+типы приводятся при слиянии. Владельцы ссылаются на профиль по имени.
+'''
+import io
+import csv
+import json
+from itertools import islice
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql as pg
+
+from . import profile, owner
+
+
+FORMATS = ('ndjson', 'csv')
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+FIELDS = {
+    'profiles': ('name', 'description', 'relay_ip', 'router_ip', 'dns_ips', 'ntp_ips',
+                 'lease_time', 'network_addr'),
+    'owners': ('profile', 'mac_addr', 'ip_addr', 'description', 'create_date', 'lease_date'),
+}
+REQUIRED = {
+    'profiles': ('name', 'relay_ip', 'lease_time', 'network_addr'),
+    'owners': ('profile', 'mac_addr'),
+}
+
+EXPORT_CHUNK = 1000
+IMPORT_CHUNK = 1000
+
+
+class TransferError(Exception):
+    pass
+
+
+def _text(column):
+    return sa.cast(column, sa.Text).label(column.name)
+
+
+def _text_array(column):
+    return sa.cast(column, pg.ARRAY(sa.Text)).label(column.name)
+
+
+def export_query(kind):
+    if kind == 'profiles':
+        t = profile
+        return sa.select([
+            t.c.name, t.c.description, _text(t.c.relay_ip), _text(t.c.router_ip),
+            _text_array(t.c.dns_ips), _text_array(t.c.ntp_ips),
+            _text(t.c.lease_time), _text(t.c.network_addr),
+        ]).order_by(t.c.name)
+    t = owner
+    return sa.select([
+        profile.c.name.label('profile'), _text(t.c.mac_addr), _text(t.c.ip_addr), t.c.description,
+        _text(t.c.create_date), _text(t.c.lease_date),
+    ]).select_from(t.join(profile)).order_by(t.c.id)
+
+
+def _csv_value(value):
+    if isinstance(value, list):
+        return '{' + ','.join(value) + '}'
+    return value
+
+
+def header(fmt, kind):
+    if fmt == 'csv':
+        buf = io.StringIO()
+        csv.writer(buf).writerow(FIELDS[kind])
+        return buf.getvalue()
+    return ''
+
+
+def encode(fmt, kind, rows):
+    fields = FIELDS[kind]
+    if fmt == 'ndjson':
+        return ''.join(json.dumps(dict(zip(fields, row)), ensure_ascii=False) + '\n' for row in rows)
+    buf = io.StringIO()
+    csv.writer(buf).writerows([_csv_value(value) for value in row] for row in rows)
+    return buf.getvalue()
+
+
+async def export(conn, kind, fmt, write, chunk=EXPORT_CHUNK):
+    ''' Выгружает все записи kind, передавая текст порциями в корутину write(text).
+    Возвращает число выгруженных записей.
+    '''
+    compiled = export_query(kind).compile(dialect=pg.dialect())
+    count = 0
+    await write(header(fmt, kind))
+    async with conn.begin():
+        await conn.execute('DECLARE transfer_export NO SCROLL CURSOR FOR ' + str(compiled), compiled.params)
+        while True:
+            rows = await (await conn.execute(
+                'FETCH FORWARD {:d} FROM transfer_export'.format(chunk)
+            )).fetchall()
+            if not rows:
+                break
+            await write(encode(fmt, kind, rows))
+            count += len(rows)
+        await conn.execute('CLOSE transfer_export')
+    return count
+
+
+def _record_values(kind, record, lineno):
+    values = []
+    for field in FIELDS[kind]:
+        value = record.get(field)
+        if isinstance(value, list):
+            value = '{' + ','.join(map(str, value)) + '}'
+        elif value == '':
+            value = None
+        elif value is not None:
+            value = str(value)
+        values.append(value)
+    for field in REQUIRED[kind]:
+        if values[FIELDS[kind].index(field)] is None:
+            raise TransferError('line {}: {} is required'.format(lineno, field))
+    return tuple(values)
+
+
+def read_records(fmt, kind, lines):
+    ''' Разбирает строки файла в кортежи текстовых значений в порядке FIELDS[kind]. '''
+    if fmt == 'ndjson':
+        for lineno, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise TransferError('line {}: {}'.format(lineno, e))
+            if not isinstance(record, dict):
+                raise TransferError('line {}: object expected'.format(lineno))
+            yield _record_values(kind, record, lineno)
+        return
+    reader = csv.DictReader(lines)
+    missing = set(REQUIRED[kind]) - set(reader.fieldnames or ())
+    if missing:
+        raise TransferError('missing columns: {}'.format(', '.join(sorted(missing))))
+    for record in reader:
+        yield _record_values(kind, record, reader.line_num)
+
+
+def staging_table_sql(kind):
+    ''' Временная таблица загрузки; n сохраняет порядок строк файла, из повторов побеждает последняя. '''
+    return 'CREATE TEMP TABLE {}_import (n serial, {}) ON COMMIT DROP'.format(
+        kind, ', '.join(field + ' text' for field in FIELDS[kind]))
+
+
+class _CopySource:
+    ''' Файл для copy_expert: отдаёт записи строками CSV по мере чтения. '''
+    def __init__(self, records):
+        self.records = iter(records)
+        self.count = 0
+        self._buf = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            batch = list(islice(self.records, IMPORT_CHUNK))
+            if not batch:
+                break
+            out = io.StringIO()
+            csv.writer(out).writerows(batch)
+            self._buf += out.getvalue()
+            self.count += len(batch)
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    readline = read
+
+
+def copy_records(cursor, kind, records):
+    ''' Загружает записи во временную таблицу через COPY (курсор psycopg2). Возвращает их число. '''
+    source = _CopySource(records)
+    cursor.copy_expert('COPY {}_import ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        kind, ', '.join(FIELDS[kind])), source)
+    return source.count
+
+
+async def insert_records(conn, kind, records, chunk=IMPORT_CHUNK):
+    ''' Загружает записи во временную таблицу пачками по chunk строк. Возвращает их число. '''
+    fields = FIELDS[kind]
+    insert = sa.text('INSERT INTO {}_import ({}) SELECT * FROM unnest({})'.format(
+        kind, ', '.join(fields), ', '.join('CAST(:{} AS text[])'.format(field) for field in fields)))
+    records = iter(records)
+    count = 0
+    while True:
+        batch = list(islice(records, chunk))
+        if not batch:
+            break
+        await conn.execute(insert, **{field: [row[i] for row in batch] for i, field in enumerate(fields)})
+        count += len(batch)
+    return count
+
+
+# Слияние возвращает (id профиля, число перенесённых строк). Владельцы вставляются в порядке
+# id профиля — в том же порядке триггер блокирует строки profile_usage. Владельцы
+# с неизвестным профилем пропускаются.
+_sql_merge = {
+    'profiles': sa.text(
+        'WITH merged AS ('
+        '  INSERT INTO profile (name, description, relay_ip, router_ip, dns_ips, ntp_ips, '
+        '    lease_time, network_addr) '
+        '  SELECT DISTINCT ON (name) name, coalesce(description, \'\'), CAST(relay_ip AS inet), '
+        '    CAST(router_ip AS inet), CAST(dns_ips AS inet[]), CAST(ntp_ips AS inet[]), '
+        '    CAST(lease_time AS interval), CAST(network_addr AS cidr) '
+        '  FROM profiles_import ORDER BY name, n DESC '
+        '  ON CONFLICT (name) DO UPDATE SET description = EXCLUDED.description, '
+        '    relay_ip = EXCLUDED.relay_ip, router_ip = EXCLUDED.router_ip, dns_ips = EXCLUDED.dns_ips, '
+        '    ntp_ips = EXCLUDED.ntp_ips, lease_time = EXCLUDED.lease_time, '
+        '    network_addr = EXCLUDED.network_addr, modify_date = now() '
+        '  RETURNING id'
+        ') SELECT id AS profile_id, 1 AS merged FROM merged'
+    ),
+    'owners': sa.text(
+        'WITH merged AS ('
+        '  INSERT INTO owner (profile_id, mac_addr, ip_addr, description, create_date, lease_date) '
+        '  SELECT DISTINCT ON (profile.id, CAST(i.mac_addr AS macaddr)) '
+        '    profile.id, CAST(i.mac_addr AS macaddr), CAST(i.ip_addr AS inet), '
+        '    coalesce(i.description, \'\'), coalesce(CAST(i.create_date AS timestamptz), now()), '
+        '    coalesce(CAST(i.lease_date AS timestamptz), now()) '
+        '  FROM owners_import AS i JOIN profile ON profile.name = i.profile '
+        '  ORDER BY profile.id, CAST(i.mac_addr AS macaddr), i.n DESC '
+        '  ON CONFLICT (profile_id, mac_addr) DO UPDATE SET ip_addr = EXCLUDED.ip_addr, '
+        '    description = EXCLUDED.description, '
+        '    lease_date = greatest(owner.lease_date, EXCLUDED.lease_date), modify_date = now() '
+        '  RETURNING profile_id'
+        ') SELECT profile_id, count(*) AS merged FROM merged GROUP BY profile_id'
+    ),
+}
+
+
+def merge_sql(kind):
+    return _sql_merge[kind]
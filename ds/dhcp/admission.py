@@ -0,0 +1,73 @@
+from collections import Counter
+from collections import defaultdict
+
+
+class Admission:
+    ''' Ограничение частоты запросов token bucket'ами по релею (giaddr) и по MAC.
+
+    rate — запросов в секунду, burst — сколько можно прислать подряд; rate = 0 отключает проверку.
+    Словари корзин очищаются целиком при превышении max_keys, чтобы поток случайных MAC
+    не съел память. Счётчики пропущенных и отброшенных запросов ведутся по каждому релею.
+    '''
+    def __init__(self, *, relay_rate=0, relay_burst=None, mac_rate=0, mac_burst=None, max_backlog=0,
+                 max_keys=100000):
+        self.relay_rate = relay_rate
+        self.relay_burst = relay_burst or max(1, relay_rate)
+        self.mac_rate = mac_rate
+        self.mac_burst = mac_burst or max(1, mac_rate)
+        self.max_backlog = max_backlog
+        self.max_keys = max_keys
+        self.stats = Counter()
+        self.relays = defaultdict(Counter)  # relay IP (int) -> admitted / shed_*
+        self._relay_buckets = {}
+        self._mac_buckets = {}
+
+    def _take(self, buckets, key, rate, burst, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.max_keys:
+                buckets.clear()
+            buckets[key] = [burst - 1, now]
+            return True
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def admit(self, relay_ip, mac, now):
+        ''' Берёт токены релея и MAC. Возвращает True, если запрос пропущен. '''
+        if self.relay_rate and not self._take(
+                self._relay_buckets, relay_ip, self.relay_rate, self.relay_burst, now):
+            self.shed(relay_ip, 'relay')
+            return False
+        if self.mac_rate and not self._take(
+                self._mac_buckets, mac, self.mac_rate, self.mac_burst, now):
+            self.shed(relay_ip, 'mac')
+            return False
+        self.stats['admitted'] += 1
+        self._relay_stats(relay_ip)['admitted'] += 1
+        return True
+
+    def saturated(self, backlog):
+        ''' True, если очередь записей в БД (backlog) достигла max_backlog. '''
+        return bool(self.max_backlog) and backlog >= self.max_backlog
+
+    def shed(self, relay_ip, reason):
+        key = 'shed_' + reason
+        self.stats[key] += 1
+        self._relay_stats(relay_ip)[key] += 1
+
+    def _relay_stats(self, relay_ip):
+        if relay_ip not in self.relays and len(self.relays) >= self.max_keys:
+            self.relays.clear()
+        return self.relays[relay_ip]
+
+    def top_shed(self, count=10):
+        ''' Релеи с наибольшим числом отброшенных запросов: [(relay IP, счётчики)]. '''
+        shed = [(sum(v for k, v in stats.items() if k.startswith('shed_')), relay_ip, stats)
+                for relay_ip, stats in self.relays.items()]
+        shed.sort(key=lambda entry: entry[0], reverse=True)
+        return [(relay_ip, stats) for total, relay_ip, stats in shed[:count] if total]
@@ -0,0 +1,51 @@
+import asyncio
+from collections import Counter
+
+
+class Batcher:
+    ''' Копит значения по ключу (более позднее значение заменяет раннее) и отдаёт их пачкой
+    в flush(items) каждые interval секунд или при накоплении size ключей.
+
+    Если flush вернул False (например, очередь задач переполнена), пачка остаётся
+    в памяти и сливается со следующей.
+    '''
+    def __init__(self, flush, *, size=500, interval=0.5, loop=None):
+        self.size = size
+        self.interval = interval
+        self.loop = loop or asyncio.get_event_loop()
+        self.items = {}
+        self.stats = Counter()
+        self._flush = flush
+        self._timer = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, key, value):
+        self.stats['added'] += 1
+        self.items[key] = value
+        if len(self.items) >= self.size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.interval, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.items:
+            return True
+
+        items, self.items = self.items, {}
+        if self._flush(items):
+            self.stats['flushes'] += 1
+            self.stats['flushed'] += len(items)
+            if len(items) > self.stats['flush_size_max']:
+                self.stats['flush_size_max'] = len(items)
+            return True
+
+        self.stats['flush_retries'] += 1
+        items.update(self.items)
+        self.items = items
+        self._timer = self.loop.call_later(self.interval, self.flush)
+        return False
@@ -0,0 +1,247 @@
+import sys
+import ipaddress
+from array import array
+from collections import Counter
+from collections import OrderedDict
+from datetime import timedelta
+
+from .proto.option import Option
+from .proto.opttypes import OptionType
+
+
+class Profile:
+    ''' Общие для всех клиентов профиля параметры ответа.
+
+    Опции ответа кодируются один раз и хранятся готовым блоком байт
+    (отдельно для каждого адреса сервера, т.к. от него зависит ServerIdentifier).
+    '''
+    __slots__ = ('id', 'relay_ip', 'router_ip', 'network_addr', 'lease_time', 'dns_ips', 'ntp_ips',
+                 'netmask', '_options')
+
+    def __init__(self, id, relay_ip, network_addr, lease_time, router_ip=None, dns_ips=None, ntp_ips=None):
+        self.id = id
+        self.relay_ip = int(ipaddress.IPv4Address(relay_ip))
+        self.router_ip = router_ip
+        self.network_addr = network_addr
+        self.lease_time = lease_time
+        self.dns_ips = dns_ips
+        self.ntp_ips = ntp_ips
+        self.netmask = ipaddress.IPv4Network(network_addr).netmask
+        self._options = {}
+
+    @classmethod
+    def from_row(cls, row, id_column='id'):
+        return cls(
+            row[id_column], row.relay_ip, row.network_addr, row.lease_time,
+            router_ip=row.router_ip, dns_ips=row.dns_ips, ntp_ips=row.ntp_ips)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'relay_ip': self.relay_ip,
+            'router_ip': str(self.router_ip) if self.router_ip else None,
+            'network_addr': str(self.network_addr),
+            'lease_time': self.lease_time.total_seconds(),
+            'dns_ips': [str(ip) for ip in self.dns_ips or []],
+            'ntp_ips': [str(ip) for ip in self.ntp_ips or []],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['id'], data['relay_ip'], ipaddress.IPv4Network(data['network_addr']),
+            timedelta(seconds=data['lease_time']),
+            router_ip=ipaddress.IPv4Address(data['router_ip']) if data['router_ip'] else None,
+            dns_ips=[ipaddress.IPv4Address(ip) for ip in data['dns_ips']],
+            ntp_ips=[ipaddress.IPv4Address(ip) for ip in data['ntp_ips']])
+
+    def _encode_options(self, server_addr):
+        options = [Option(OptionType.SubnetMask, self.netmask)]
+        if self.router_ip:
+            options.append(Option(OptionType.Router, self.router_ip))
+        if self.dns_ips:
+            options.append(Option(OptionType.DomainNameServers, self.dns_ips))
+        if self.ntp_ips:
+            options.append(Option(OptionType.NTPServer, self.ntp_ips))
+        options.append(Option(OptionType.IPaddressLeaseTime, int(self.lease_time.total_seconds())))
+        if server_addr:
+            options.append(Option(OptionType.ServerIdentifier, server_addr))
+
+        buffer = bytearray(2 + 255)
+        blob = bytearray()
+        for option in options:
+            size = option.pack_into(buffer, 0)
+            blob += buffer[:size]
+        return bytes(blob)
+
+    def reply_options(self, server_addr):
+        blob = self._options.get(server_addr)
+        if blob is None:
+            blob = self._options[server_addr] = self._encode_options(server_addr)
+        return blob
+
+
+# значение MAC для свободной ячейки в выгрузке столбцов
+FREE_SLOT = 0xffffffffffffffff
+
+
+class LeaseCache:
+    ''' Компактный кэш привязок: MAC (48-битное int) -> id владельца, IP (int), id профиля.
+
+    Вместо словаря на каждую запись значения лежат в параллельных массивах,
+    а словарь хранит только номер ячейки. Параметры профилей хранятся один раз в profiles.
+    Для каждой записи также хранится последняя записанная в БД lease_date (unix time, 0 — неизвестна).
+    '''
+    def __init__(self):
+        self.profiles = {}
+        self.relays = {}  # relay IP (int) -> id профиля
+        self._slots = {}
+        self._owner_id = array('i')
+        self._ip = array('I')
+        self._profile_id = array('i')
+        self._lease_date = array('I')
+        self._free = []
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, mac):
+        return mac in self._slots
+
+    def get(self, mac):
+        slot = self._slots.get(mac)
+        if slot is None:
+            return None
+        return self._owner_id[slot], self._ip[slot], self._profile_id[slot]
+
+    def set(self, mac, owner_id, ip, profile_id, lease_date=0):
+        slot = self._slots.get(mac)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._owner_id)
+                self._owner_id.append(0)
+                self._ip.append(0)
+                self._profile_id.append(0)
+                self._lease_date.append(0)
+            self._slots[mac] = slot
+            self._lease_date[slot] = lease_date
+        elif self._owner_id[slot] != owner_id:
+            self._lease_date[slot] = lease_date
+        elif lease_date > self._lease_date[slot]:
+            self._lease_date[slot] = lease_date
+        self._owner_id[slot] = owner_id
+        self._ip[slot] = ip
+        self._profile_id[slot] = profile_id
+
+    def renew_lease(self, mac, now, refresh):
+        ''' Отмечает продление аренды в момент now (unix time).
+
+        Возвращает True, если lease_date надо записать в БД: записанное значение старше refresh секунд.
+        '''
+        slot = self._slots.get(mac)
+        if slot is None or now - self._lease_date[slot] < refresh:
+            return False
+        self._lease_date[slot] = now
+        return True
+
+    def remove(self, mac):
+        slot = self._slots.pop(mac, None)
+        if slot is None:
+            return False
+        self._free.append(slot)
+        return True
+
+    def macs(self):
+        return list(self._slots)
+
+    def items(self):
+        for mac, slot in self._slots.items():
+            yield mac, (self._owner_id[slot], self._ip[slot], self._profile_id[slot])
+
+    def memory_usage(self):
+        ''' Примерный объём памяти, занятый записями (без профилей), в байтах. '''
+        size = sys.getsizeof(self._slots) + sys.getsizeof(self._free)
+        size += sum(sys.getsizeof(mac) + sys.getsizeof(slot) for mac, slot in self._slots.items())
+        for arr in (self._owner_id, self._ip, self._profile_id, self._lease_date):
+            size += sys.getsizeof(arr)
+        return size
+
+    def set_profile(self, profile):
+        old = self.profiles.get(profile.id)
+        if old is not None and self.relays.get(old.relay_ip) == old.id:
+            del self.relays[old.relay_ip]
+        self.profiles[profile.id] = profile
+        self.relays[profile.relay_ip] = profile.id
+
+    def remove_profile(self, profile_id):
+        profile = self.profiles.pop(profile_id, None)
+        if profile is not None and self.relays.get(profile.relay_ip) == profile_id:
+            del self.relays[profile.relay_ip]
+
+    def load_profiles(self, profiles):
+        self.profiles = {}
+        self.relays = {}
+        for profile in profiles:
+            self.set_profile(profile)
+
+    def dump_columns(self):
+        ''' Возвращает столбцы (mac, owner_id, ip, profile_id, lease_date) в порядке ячеек. '''
+        macs = array('Q', [FREE_SLOT]) * len(self._owner_id)
+        for mac, slot in self._slots.items():
+            macs[slot] = mac
+        return macs, self._owner_id, self._ip, self._profile_id, self._lease_date
+
+    def load_columns(self, macs, owner_ids, ips, profile_ids, lease_dates):
+        ''' Заменяет содержимое кэша столбцами из dump_columns() (подойдут и memoryview). '''
+        self._owner_id = array('i', owner_ids)
+        self._ip = array('I', ips)
+        self._profile_id = array('i', profile_ids)
+        self._lease_date = array('I', lease_dates)
+        self._slots = {}
+        self._free = []
+        for slot, mac in enumerate(macs):
+            if mac == FREE_SLOT:
+                self._free.append(slot)
+            else:
+                self._slots[mac] = slot
+
+
+class ReplyCache:
+    ''' Готовые ответы на повторы запросов (ретрансмиссии клиента, дубли от нескольких релеев).
+
+    LRU не больше size записей, запись живёт ttl секунд.
+    '''
+    def __init__(self, size=4096, ttl=3.0):
+        self.size = size
+        self.ttl = ttl
+        self.stats = Counter()
+        self._items = OrderedDict()  # ключ -> (срок, ответ)
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, now):
+        entry = self._items.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        if entry[0] < now:
+            del self._items[key]
+            self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return None
+        self._items.move_to_end(key)
+        self.stats['hits'] += 1
+        return entry[1]
+
+    def put(self, key, reply, now):
+        self._items[key] = (now + self.ttl, reply)
+        self._items.move_to_end(key)
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        self._items.clear()
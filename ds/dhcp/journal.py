@@ -0,0 +1,117 @@
+''' Журнал отложенной записи задач БД.
+
+Записи, которые не удалось отдать в БД (очередь переполнена, соединение потеряно, сервер
+останавливается), дописываются в текущий сегмент — файл JSON строк вида [kind, payload].
+fsync выполняется не на каждую запись, а не реже чем раз в fsync_interval секунд.
+
+Сегмент закрывается при достижении segment_size байт или явным вызовом rotate();
+закрытые сегменты проигрываются в БД по порядку и удаляются после коммита.
+'''
+import os
+import json
+import asyncio
+import logging
+from collections import Counter
+
+
+SUFFIX = '.jlog'
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    def __init__(self, directory, *, fsync_interval=0.2, segment_size=4 * 1024 * 1024, loop=None):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.loop = loop or asyncio.get_event_loop()
+        self.stats = Counter()
+        self._file = None
+        self._path = None
+        self._seq = 0
+        self._timer = None
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self.sealed()
+        if segments:
+            self._seq = self._segment_seq(segments[-1])
+            logger.warning('journal %s has %d unreplayed segments', self.directory, len(segments))
+        self._open_segment()
+
+    def _segment_seq(self, path):
+        return int(os.path.basename(path)[:-len(SUFFIX)])
+
+    def _open_segment(self):
+        self._seq += 1
+        self._path = os.path.join(self.directory, '{:016d}{}'.format(self._seq, SUFFIX))
+        self._file = open(self._path, 'ab')
+
+    def pending(self):
+        ''' Есть ли записи, ещё не проигранные в БД. '''
+        return self._file is not None and (self._file.tell() > 0 or bool(self.sealed()))
+
+    def append(self, kind, payload):
+        data = (json.dumps([kind, payload], separators=(',', ':')) + '\n').encode('utf-8')
+        self._file.write(data)
+        self.stats['appended'] += 1
+        self.stats['bytes'] += len(data)
+        if self._file.tell() >= self.segment_size:
+            self.rotate()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.fsync_interval, self.sync)
+
+    def sync(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.stats['fsyncs'] += 1
+
+    def rotate(self):
+        ''' Закрывает текущий сегмент, если в нём есть записи, и начинает новый. '''
+        if not self._file.tell():
+            return
+        self.sync()
+        self._file.close()
+        self._open_segment()
+
+    def sealed(self):
+        ''' Закрытые сегменты в порядке записи. '''
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SUFFIX))
+        paths = [os.path.join(self.directory, name) for name in names]
+        return [path for path in paths if path != self._path]
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            for lineno, line in enumerate(f, 1):
+                try:
+                    kind, payload = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # недописанная строка после аварийной остановки
+                    logger.warning('journal %s:%d is broken, skipped', path, lineno)
+                    self.stats['broken'] += 1
+                    continue
+                yield kind, payload
+
+    def remove(self, path):
+        os.unlink(path)
+        self.stats['replayed_segments'] += 1
+
+    def discard(self, path):
+        ''' Убирает сегмент из проигрывания, оставляя его на диске для разбора. '''
+        os.rename(path, path + '.failed')
+        self.stats['discarded_segments'] += 1
+
+    def close(self):
+        if self._file is None:
+            return
+        self.sync()
+        empty = not self._file.tell()
+        self._file.close()
+        self._file = None
+        if empty:
+            os.unlink(self._path)
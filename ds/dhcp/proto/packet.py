@@ -13,6 +13,8 @@ from .dhcpmsg import MessageType
 
 MAC_ADDRESS_LEN = 6
 MIN_PACKET_LEN = 576
+# op htype hlen hops xid secs flags ciaddr yiaddr siaddr giaddr chaddr
+REPLY_HEADER = struct.Struct('!4BL2H4L6s')
 
 
 class HardwareAddressType(IntEnum):
@@ -93,6 +95,7 @@ class Packet:
             sub_opt = AgentInformationSubOption.unpack_from(opt_value, offset)
             if sub_opt.type == AgentInformationOptionType.CircuitID:
                 return sub_opt.value
+            offset += sub_opt._byte_size
         return None
 
     @classmethod
@@ -172,3 +175,184 @@ class Packet:
         pkt.giaddr = ipaddress.IPv4Address(self.giaddr)
         pkt.hops = self.hops
         return pkt
+
+
+class PacketView:
+    ''' Ленивое представление принятого пакета поверх memoryview.
+
+    Поля заголовка разбираются при первом обращении, для опций строится индекс смещений.
+    Конструктор отбрасывает заведомый мусор: короткий пакет, неверный magic cookie, hlen != 6.
+    '''
+    Op = Packet.Op
+    HEADER_LEN = Packet.STRUCT.size
+    OPTIONS_OFFSET = HEADER_LEN + 4
+    _UINT16 = struct.Struct('!H')
+    _UINT32 = struct.Struct('!L')
+
+    __slots__ = ('_buf', '_index', '_chaddr', '_giaddr')
+
+    def __init__(self, data):
+        buf = memoryview(data)
+        if len(buf) < self.OPTIONS_OFFSET:
+            raise ValueError('Packet is too short.')
+        if buf[self.HEADER_LEN:self.OPTIONS_OFFSET] != Packet.MAGIC_COOKIE:
+            raise ValueError('Options magic cookie not matched.')
+        if buf[2] != MAC_ADDRESS_LEN:
+            raise ValueError('Invalid hardware address size.')
+        self._buf = buf
+        self._index = None
+        self._chaddr = None
+        self._giaddr = None
+
+    def __repr__(self):
+        return repr(self.to_packet())
+
+    def to_packet(self):
+        ''' Полный разбор пакета, нужен только для отладочного вывода. '''
+        return Packet.unpack_from(self._buf)
+
+    @property
+    def op(self):
+        return self._buf[0]
+
+    @property
+    def htype(self):
+        return self._buf[1]
+
+    @property
+    def hlen(self):
+        return self._buf[2]
+
+    @property
+    def hops(self):
+        return self._buf[3]
+
+    @property
+    def xid(self):
+        return self._UINT32.unpack_from(self._buf, 4)[0]
+
+    @property
+    def secs(self):
+        return self._UINT16.unpack_from(self._buf, 8)[0]
+
+    @property
+    def flags(self):
+        return self._UINT16.unpack_from(self._buf, 10)[0]
+
+    @property
+    def ciaddr_int(self):
+        return self._UINT32.unpack_from(self._buf, 12)[0]
+
+    @property
+    def giaddr_int(self):
+        return self._UINT32.unpack_from(self._buf, 24)[0]
+
+    @property
+    def giaddr(self):
+        if self._giaddr is None:
+            self._giaddr = ipaddress.IPv4Address(self.giaddr_int)
+        return self._giaddr
+
+    @property
+    def chaddr_bytes(self):
+        return self._buf[28:28 + MAC_ADDRESS_LEN].tobytes()
+
+    @property
+    def chaddr_int(self):
+        return int.from_bytes(self._buf[28:28 + MAC_ADDRESS_LEN], 'big')
+
+    @property
+    def chaddr(self):
+        if self._chaddr is None:
+            self._chaddr = mac_to_string(self._buf[28:28 + MAC_ADDRESS_LEN])
+        return self._chaddr
+
+    def _build_index(self):
+        buf = self._buf
+        index = {}
+        offset = self.OPTIONS_OFFSET
+        end = len(buf)
+        while offset < end:
+            code = buf[offset]
+            if code == OptionType.Pad:
+                offset += 1
+                continue
+            if code == OptionType.End or offset + 1 >= end:
+                break
+            size = buf[offset + 1]
+            if offset + 2 + size > end:
+                raise ValueError('Option {} is truncated.'.format(code))
+            # как и в Packet.unpack_from, повторная опция перекрывает предыдущую
+            index[code] = (offset + 2, size)
+            offset += 2 + size
+        self._index = index
+        return index
+
+    def check_options(self):
+        ''' Строит индекс опций заранее: ValueError, если опция обрезана. '''
+        if self._index is None:
+            self._build_index()
+
+    def get_option(self, type_code):
+        index = self._index
+        if index is None:
+            index = self._build_index()
+        pos = index.get(type_code)
+        if pos is None:
+            return None
+        offset, size = pos
+        return self._buf[offset:offset + size].tobytes()
+
+    @property
+    def message_type(self):
+        value = self.get_option(OptionType.DHCPMessageType)
+        if not value:
+            return None
+        try:
+            return MessageType(value[0])
+        except ValueError:
+            return None
+
+    def get_circuit_id(self):
+        opt_value = self.get_option(OptionType.AgentInformation) or b''
+        offset = 0
+        while offset + 1 < len(opt_value):
+            size = opt_value[offset + 1]
+            if opt_value[offset] == AgentInformationOptionType.CircuitID:
+                return opt_value[offset + 2:offset + 2 + size]
+            offset += 2 + size
+        return None
+
+    def pack_reply(self, message_type, yiaddr, siaddr, options):
+        ''' Собирает ответ сразу в байты: заголовок, заранее закодированный блок опций
+        и опция 82 из запроса без изменений. Адреса передаются как int.
+        '''
+        agent_info = None
+        index = self._index if self._index is not None else self._build_index()
+        pos = index.get(OptionType.AgentInformation)
+        if pos is not None:
+            offset, size = pos
+            agent_info = self._buf[offset - 2:offset + size]
+
+        size = self.OPTIONS_OFFSET + 3 + len(options) + 1
+        if agent_info is not None:
+            size += len(agent_info)
+        buffer = bytearray(size)
+        REPLY_HEADER.pack_into(
+            buffer, 0,
+            Packet.Op.REPLY, HardwareAddressType.ETHERNET, MAC_ADDRESS_LEN, self.hops,
+            self.xid, 0, 0,
+            0, yiaddr, siaddr, self.giaddr_int,
+            self._buf[28:28 + MAC_ADDRESS_LEN].tobytes())
+        offset = self.HEADER_LEN
+        buffer[offset:offset + 4] = Packet.MAGIC_COOKIE
+        offset += 4
+        buffer[offset:offset + 3] = bytes((OptionType.DHCPMessageType, 1, message_type))
+        offset += 3
+        buffer[offset:offset + len(options)] = options
+        offset += len(options)
+        if agent_info is not None:
+            buffer[offset:offset + len(agent_info)] = agent_info
+            offset += len(agent_info)
+        buffer[offset] = OptionType.End
+        return buffer
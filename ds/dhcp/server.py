@@ -3,18 +3,33 @@ from enum import Enum
 import logging
 import socket
 from collections import defaultdict
+from collections import Counter
+from collections import deque
+from functools import partial
 import ipaddress
 import time
 from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 
 import aiopg
 from sqlalchemy.dialects import postgresql as pg
 import sqlalchemy as sa
-import psycopg2
 
 from .proto.packet import Packet
-from .proto.opttypes import OptionType
+from .proto.packet import PacketView
 from .proto.dhcpmsg import MessageType
+from .cache import Profile
+from .cache import LeaseCache
+from .cache import ReplyCache
+from .batch import Batcher
+from .journal import Journal
+from .timerwheel import TimerWheel
+from . import snapshot
+from .util import ip_to_int
+from .util import mac_to_int
+from .util import int_to_mac
+from .util import circuit_id_text
 from ds import db
 
 
@@ -22,19 +37,26 @@ class BindToDeviceError(Exception): pass
 
 
 class _Listener:
-    def __init__(self, interface, reader, loop, *, port=67, server_addr=None, bufsize=4096, wqueue=10):
+    def __init__(self, interface, reader, loop, *, port=67, server_addr=None, bufsize=4096, wqueue=256,
+                 recv_batch=64, reuse_port=False):
         self.interface = interface
         self.server_addr = None
         self.bufsize = bufsize
+        self.recv_batch = max(1, int(recv_batch))
         self.loop = loop
         self._reader = reader
         self._is_writing = False
-        self._write_queue = asyncio.Queue(wqueue, loop=loop)
+        self.wqueue = wqueue
+        self._write_queue = deque()
+        self.stats = Counter()
         self.logger = logging.getLogger(__name__)
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # несколько процессов слушают один адрес, ядро раскладывает датаграммы между ними
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.setblocking(False)
         sock.bind((interface, int(port)))
 
@@ -47,48 +69,161 @@ class _Listener:
         self.logger.info('listener binded to %s:%s', interface, port)
 
     def _handle_read(self):
-        data, address = self._s.recvfrom(self.bufsize)
-        self.logger.debug('listener %s: recieved %d octets from %s', self.interface, len(data), address)
-        future = self._reader(self, address, data)
-        asyncio.ensure_future(future, loop=self.loop)
+        # вычитываем сокет пачкой до EAGAIN, чтобы не платить за пробуждение цикла
+        # и создание задачи на каждую датаграмму
+        batch = []
+        recvfrom = self._s.recvfrom
+        for _ in range(self.recv_batch):
+            try:
+                data, address = recvfrom(self.bufsize)
+            except (BlockingIOError, InterruptedError):
+                break
+            batch.append((address, data))
+        if not batch:
+            return
+
+        self._count_batch(len(batch))
+        self.logger.debug('listener %s: recieved batch of %d datagrams', self.interface, len(batch))
+        self._reader(self, batch)
+
+    def _count_batch(self, size):
+        stats = self.stats
+        stats['recv_batches'] += 1
+        stats['recv_datagrams'] += size
+        if size >= self.recv_batch:
+            stats['recv_batches_full'] += 1
+        if size > stats['recv_batch_max']:
+            stats['recv_batch_max'] = size
 
     def _handle_write(self):
-        try:
-            address, data = self._write_queue.get_nowait()
-            sent = self._s.sendto(data, address)
-            self.logger.debug('listener %s: sent %d/%d octets to %s', self.interface, sent, len(data), address)
-        except asyncio.QueueEmpty:
+        queue = self._write_queue
+        while queue:
+            address, data = queue[0]
+            try:
+                sent = self._s.sendto(data, address)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.stats['send_errors'] += 1
+                self.logger.warning('listener %s: send to %s failed: %s', self.interface, address, e)
+            else:
+                self.logger.debug('listener %s: sent %d/%d octets to %s', self.interface, sent, len(data), address)
+            queue.popleft()
+        self.stats['wqueue_depth'] = len(queue)
+        if not queue:
             self.loop.remove_writer(self._s.fileno())
             self._is_writing = False
 
-    async def _write(self, address, data):
+    def _enqueue(self, address, data):
+        queue = self._write_queue
+        if len(queue) >= self.wqueue:
+            self.stats['send_dropped'] += 1
+            self.logger.warning('listener %s: write queue is full, reply to %s droped', self.interface, address)
+            return
+        queue.append((address, data))
+        self.stats['send_queued'] += 1
+        self.stats['wqueue_depth'] = len(queue)
+        if len(queue) > self.stats['wqueue_depth_max']:
+            self.stats['wqueue_depth_max'] = len(queue)
         if not self._is_writing:
             self.loop.add_writer(self._s.fileno(), self._handle_write)
             self._is_writing = True
-        await self._write_queue.put((address, data))
 
-    async def send(self, address, data):
+    def send(self, address, data):
         host, port = address
         if host == '0.0.0.0':
             address = ('255.255.255.255', port)
-        await self._write(address, data)
+        if self._write_queue:
+            # не обгоняем уже ожидающие отправки ответы
+            self._enqueue(address, data)
+            return
+        try:
+            sent = self._s.sendto(data, address)
+        except (BlockingIOError, InterruptedError):
+            self._enqueue(address, data)
+        except OSError as e:
+            self.stats['send_errors'] += 1
+            self.logger.warning('listener %s: send to %s failed: %s', self.interface, address, e)
+        else:
+            self.stats['send_direct'] += 1
+            self.logger.debug('listener %s: sent %d/%d octets to %s', self.interface, sent, len(data), address)
 
 
 class AsyncServer:
+    # handle_request_nowait() возвращает DEFER, если запрос нужно обработать в корутине
+    DEFER = object()
+    # отбрасывать запросы не от релеев (hops == 0) ещё до разбора опций
+    relayed_only = False
+
     def __init__(self, loop=None):
         self.loop = loop or asyncio.get_event_loop()
         self._listeners = {}
         self.logger = logging.getLogger(__name__)
 
     def bind(self, interface, **kwargs):
-        self._listeners[interface] = _Listener(interface, self._handle_packet, self.loop, **kwargs)
+        self._listeners[interface] = _Listener(interface, self._handle_batch, self.loop, **kwargs)
+
+    def stats(self):
+        total = Counter()
+        for listener in self._listeners.values():
+            _merge_stats(total, listener.stats)
+        return total
+
+    def _handle_batch(self, listener, batch):
+        deferred = []
+        for address, data in batch:
+            pkt = self._handle_packet_nowait(listener, address, data)
+            if pkt is not None:
+                deferred.append((address, pkt))
+        if deferred:
+            listener.stats['deferred'] += len(deferred)
+            future = self._handle_deferred(listener, deferred)
+            asyncio.ensure_future(future, loop=self.loop)
 
-    async def _handle_packet(self, listener, address, data):
+    def _handle_packet_nowait(self, listener, address, data):
+        ''' Обрабатывает пакет прямо в callback'е чтения.
+        Возвращает разобранный пакет, если его нужно передать в асинхронный обработчик.
+        '''
         try:
-            pkt = Packet.unpack_from(data)
+            try:
+                pkt = PacketView(data)
+                pkt.check_options()
+            except ValueError as e:
+                listener.stats['rejected'] += 1
+                self.logger.debug('listener %s: junk packet from %s: %s', listener.interface, address, e)
+                return None
+            if self.relayed_only and not pkt.hops:
+                listener.stats['rejected'] += 1
+                return None
 
-            self.logger.debug('REQUEST PACKET:\n%s', pkt)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                try:
+                    self.logger.debug('REQUEST PACKET:\n%s', pkt.to_packet())
+                except Exception as e:
+                    # полный разбор строже PacketView, на обслуживание пакета это влиять не должно
+                    self.logger.debug('REQUEST PACKET from %s is not parsed: %s', address, e)
 
+            if pkt.op == Packet.Op.REQUEST:
+                reply_pkt = self.handle_request_nowait(pkt, address, listener)
+                if reply_pkt is self.DEFER:
+                    return pkt
+            elif pkt.op == Packet.Op.REPLY:
+                return pkt
+            else:
+                reply_pkt = None
+
+            if reply_pkt:
+                listener.send(address, self._pack_reply(reply_pkt))
+        except Exception:
+            self.logger.exception('an error occured when handling input packet from %s (%s)', listener.interface, address)
+        return None
+
+    async def _handle_deferred(self, listener, batch):
+        for address, pkt in batch:
+            await self._handle_packet(listener, address, pkt)
+
+    async def _handle_packet(self, listener, address, pkt):
+        try:
             if pkt.op == Packet.Op.REQUEST:
                 reply_pkt = await self.handle_request(pkt, address, listener)
             elif pkt.op == Packet.Op.REPLY:
@@ -97,14 +232,26 @@ class AsyncServer:
                 reply_pkt = None
 
             if reply_pkt:
-                reply_pkt.op = Packet.Op.REPLY
-                reply_pkt.flags = 0
-                data = reply_pkt.pack()
-                self.logger.debug('REPLY PACKET:\n%s', reply_pkt)
-                await listener.send(address, data)
+                listener.send(address, self._pack_reply(reply_pkt))
         except Exception:
             self.logger.exception('an error occured when handling input packet from %s (%s)', listener.interface, address)
 
+    def _pack_reply(self, reply_pkt):
+        if isinstance(reply_pkt, (bytes, bytearray)):
+            # ответ уже собран обработчиком
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('REPLY PACKET:\n%s', Packet.unpack_from(reply_pkt))
+            return reply_pkt
+        reply_pkt.op = Packet.Op.REPLY
+        reply_pkt.flags = 0
+        data = reply_pkt.pack()
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('REPLY PACKET:\n%s', reply_pkt)
+        return data
+
+    def handle_request_nowait(self, pkt, address, listener):
+        return self.DEFER
+
     async def handle_request(self, pkt, address, listener):
         return None
 
@@ -115,32 +262,218 @@ class AsyncServer:
 class DBTask(Enum):
     SHUTDOWN = 0  # Завершить обрабутку
     LOAD_OWNERS = 1  # Загрузить весь список привязок
-    ADD_STAGING = 2  # Добавить в список ожидающих привязки
-    UPDATE_LEASE = 3  # Обновить дату последней аренды
-    RELOAD_ITEM = 4  # перезагрузить профиль для указаной записи
-    REMOVE_STAGING = 5  # удалить MAC из staging кэша
-    REMOVE_ACTIVE = 6  # удалить MAC из активного кэша
-    RELOAD_PROFILE = 7  # перезагрузить все записи с заданым профилем
+    ADD_STAGING = 2  # Добавить в список ожидающих привязки пачкой {MAC: (id профиля, circuit id)}
+    UPDATE_LEASE = 3  # Обновить даты последней аренды пачкой {owner id: дата}
+    RELOAD = 4  # перезагрузить записи и строки профилей (ids записей, ids профилей)
+    REMOVE_STAGING = 5  # удалить MAC из staging кэша, список MAC
+    REMOVE_ACTIVE = 6  # удалить MAC из активного кэша, список MAC
+    RESYNC = 8  # догрузить изменения после watermark (или переданного времени), удалить из кэша удалённые
 
 
 class DBChannelListener:
-    def __init__(self, conn_params, channel):
+    ''' LISTEN на отдельном соединении с переподключением.
+
+    Уведомления складываются в queue. Соединение проверяется запросом раз в keepalive секунд;
+    при обрыве переподключается с нарастающей задержкой, после чего кладёт в очередь
+    RECONNECTED — уведомления за время обрыва потеряны и кэш надо досинхронизировать.
+    '''
+    RECONNECTED = object()
+    RECONNECT_DELAY = 1.0
+    MAX_RECONNECT_DELAY = 30.0
+
+    def __init__(self, conn_params, channel, *, keepalive=10.0, loop=None):
         self.conn_params = conn_params
         self.channel = channel
-        self.queue = None
+        self.keepalive = keepalive
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue = asyncio.Queue(loop=self.loop)
+        self.conn = None
+        self.reconnects = 0
+        self._watch_future = None
+        self.logger = logging.getLogger(__name__)
 
     async def start(self):
+        await self._connect()
+        self._watch_future = asyncio.ensure_future(self._watch(), loop=self.loop)
+
+    async def _connect(self):
         self.conn = await aiopg.connect(**self.conn_params)
         async with self.conn.cursor() as cur:
             await cur.execute('LISTEN {}'.format(self.channel))
-        self.queue = self.conn.notifies
+
+    async def _forward(self, conn):
+        while True:
+            msg = await conn.notifies.get()
+            await self.queue.put(msg)
+
+    async def _alive(self):
+        try:
+            async with self.conn.cursor() as cur:
+                await asyncio.wait_for(cur.execute('SELECT 1'), self.keepalive, loop=self.loop)
+        except Exception as e:
+            self.logger.error('channel %s connection is lost: %s', self.channel, e)
+            return False
+        return not self.conn.closed
+
+    async def _watch(self):
+        try:
+            while True:
+                forward = asyncio.ensure_future(self._forward(self.conn), loop=self.loop)
+                try:
+                    while await self._alive():
+                        await asyncio.sleep(self.keepalive, loop=self.loop)
+                finally:
+                    forward.cancel()
+                self.conn.close()
+                await self._reconnect()
+        except asyncio.CancelledError:
+            pass
+
+    async def _reconnect(self):
+        delay = self.RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay, loop=self.loop)
+            try:
+                await self._connect()
+            except Exception as e:
+                self.logger.error('can not reconnect channel %s: %s', self.channel, e)
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+                continue
+            self.reconnects += 1
+            self.logger.info('channel %s reconnected', self.channel)
+            await self.queue.put(self.RECONNECTED)
+            return
 
     async def stop(self):
-        self.conn.close()
+        if self._watch_future is not None:
+            self._watch_future.cancel()
+        if self.conn is not None:
+            self.conn.close()
         await self.queue.put(None)
 
 
+def _merge_stats(total, stats, prefix=''):
+    for key, value in stats.items():
+        key = prefix + key
+        if key.endswith('_max'):
+            total[key] = max(total[key], value)
+        else:
+            total[key] += value
+
+
+def _chunks(items, size):
+    keys = list(items)
+    for start in range(0, len(keys), size):
+        yield {key: items[key] for key in keys[start:start + size]}
+
+
+def _int_array(values):
+    return sa.literal(sorted(values), pg.ARRAY(sa.Integer))
+
+
+class DBLane:
+    ''' Очередь задач БД, которую обрабатывает отдельная корутина на своём соединении из пула.
+    Задачи одной очереди выполняются строго по порядку.
+
+    Пока соединения нет, очередь не принимает задачи через put_nowait(), а уже поставленные
+    отдаются в spill(task, params) (если он задан и берёт задачу), чтобы не держать их в памяти.
+    Задача, завершившаяся ошибкой, тоже отдаётся в spill.
+    '''
+    RECONNECT_DELAY = 1.0
+    MAX_RECONNECT_DELAY = 30.0
+
+    def __init__(self, name, handler, loop, *, maxsize=1000, spill=None):
+        self.name = name
+        self.handler = handler
+        self.loop = loop
+        self.spill = spill
+        self.queue = asyncio.Queue(maxsize=maxsize, loop=loop)
+        self.stats = Counter()
+        self.connected = False
+        self.closing = False
+        self.logger = logging.getLogger(__name__)
+
+    def put_nowait(self, task):
+        if not self.connected:
+            return False
+        try:
+            self.queue.put_nowait(task)
+        except asyncio.QueueFull:
+            return False
+        self._count_depth()
+        return True
+
+    async def put(self, task):
+        await self.queue.put(task)
+        self._count_depth()
+
+    def _count_depth(self):
+        depth = self.queue.qsize()
+        if depth > self.stats['depth_max']:
+            self.stats['depth_max'] = depth
+
+    def _spill(self, task, params):
+        if self.spill is not None and self.spill(task, params):
+            self.stats['spilled'] += 1
+            return True
+        return False
+
+    def spill_queued(self):
+        kept = []
+        while not self.queue.empty():
+            task, params = self.queue.get_nowait()
+            if task is DBTask.SHUTDOWN or not self._spill(task, params):
+                kept.append((task, params))
+        for task in kept:
+            self.queue.put_nowait(task)
+
+    async def run(self, engine):
+        delay = self.RECONNECT_DELAY
+        while True:
+            try:
+                conn = await engine.acquire()
+            except Exception as e:
+                self.logger.error('db lane %s: can not connect: %s', self.name, e)
+                self.spill_queued()
+                if self.closing:
+                    return
+                await asyncio.sleep(delay, loop=self.loop)
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+                continue
+
+            delay = self.RECONNECT_DELAY
+            self.connected = True
+            try:
+                if await self._handle_tasks(conn):
+                    return
+            finally:
+                self.connected = False
+                engine.release(conn)
+            self.spill_queued()
+
+    async def _handle_tasks(self, conn):
+        ''' Возвращает True при SHUTDOWN и False, если соединение потеряно. '''
+        while True:
+            task, params = await self.queue.get()
+            self.logger.info('db lane %s: handling task %s', self.name, task.name)
+            if task is DBTask.SHUTDOWN:
+                return True
+            try:
+                await self.handler(conn, task, params)
+            except Exception:
+                self.stats['failed'] += 1
+                self.logger.exception('db lane %s: task %s failed', self.name, task.name)
+                if not self._spill(task, params):
+                    self.logger.error('db lane %s: task %s is lost', self.name, task.name)
+                if conn.closed:
+                    return False
+            else:
+                self.stats['done'] += 1
+
+
 class DHCPServer(AsyncServer):
+    relayed_only = True
+
     sql_select_owner = sa.select([
         db.profile.c.relay_ip,
         db.profile.c.router_ip,
@@ -148,35 +481,213 @@ class DHCPServer(AsyncServer):
         db.profile.c.lease_time,
         db.profile.c.dns_ips,
         db.profile.c.ntp_ips,
+        db.owner.c.profile_id,
         db.owner.c.mac_addr,
         db.owner.c.ip_addr,
+        db.owner.c.lease_date,
         db.owner.c.id,
+        db.owner.c.modify_date,
+        db.profile.c.modify_date.label('profile_modify_date'),
     ]).select_from(
         db.owner.join(db.profile)
     )
 
-    def __init__(self, db, channel, default_server_addr=None, loop=None):
+    sql_update_leases = sa.text(
+        'UPDATE owner SET lease_date = v.lease_date '
+        'FROM unnest(CAST(:ids AS integer[]), CAST(:dates AS timestamptz[])) AS v(id, lease_date) '
+        'WHERE owner.id = v.id AND owner.lease_date < v.lease_date'
+    )
+
+    sql_insert_staging = sa.text(
+        'INSERT INTO owner (mac_addr, profile_id, description) '
+        'SELECT * FROM unnest(CAST(:macs AS macaddr[]), CAST(:profile_ids AS integer[]), '
+        'CAST(:descriptions AS varchar[])) '
+        'ON CONFLICT DO NOTHING '
+        'RETURNING mac_addr'
+    )
+
+    # не чаще раза в столько секунд предупреждать о запросах с одного неизвестного релея
+    UNKNOWN_RELAY_WARN_INTERVAL = 60
+
+    # изменения, записанные незадолго до watermark, могли закоммититься позже неё
+    WATERMARK_MARGIN = 60
+    # сколько секунд хранятся строки owner_deleted; после более долгого перерыва кэш сверяется целиком
+    TOMBSTONE_RETENTION = 7 * 86400
+    FULL_DIFF_CHUNK = 10000
+    SHUTDOWN_TIMEOUT = 10
+    # больше стольких id в одной перезагрузке не копим
+    RELOAD_BATCH_MAX = 5000
+    JOURNAL_REPLAY_ATTEMPTS = 3
+
+    def __init__(self, db, channel, default_server_addr=None, loop=None, *, stats_interval=60,
+                 load_chunk=5000, snapshot_file=None, snapshot_interval=300, snapshot_max_age=86400,
+                 lease_flush_size=500, lease_flush_interval=0.5,
+                 staging_flush_size=200, staging_flush_interval=0.2, staging_ttl=600,
+                 lease_refresh=0.5, db_workers=2, db_queue_size=1000,
+                 journal_dir=None, journal_fsync_interval=0.2, journal_replay_interval=5,
+                 reconcile_interval=300, reload_debounce=0.05, reply_cache_size=4096, reply_cache_ttl=3,
+                 admission=None):
         super().__init__(loop)
         self.default_server_addr = default_server_addr
+        self.stats_interval = stats_interval
+        self.load_chunk = load_chunk
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_max_age = snapshot_max_age
+        self.lease_refresh = lease_refresh
+        self.reconcile_interval = reconcile_interval
+        self.reload_debounce = reload_debounce
+        self._reload_items = set()
+        self.replies = ReplyCache(reply_cache_size, reply_cache_ttl) if reply_cache_ttl else None
+        self.admission = admission
+        self._reload_profiles = set()
+        # наибольшая modify_date из загруженных строк owner и profile, unix time
+        self.watermark = None
+        # время (в БД) последнего чтения owner_deleted: более ранние удаления уже применены
+        self.tombstone_mark = None
+        self._started = time.monotonic()
+        self._first_reply_sent = False
 
         self.db = db
         self.channel = channel
-        self.db_tasks = asyncio.Queue(maxsize=1000, loop=loop)
-        self.maps = {}
-        self.maps_staging = {}
+        # записи аренд и staging раскладываются по db_workers очередям по id владельца / MAC,
+        # так что задачи одного абонента всегда выполняются по порядку в одной очереди;
+        # перезагрузки из канала управления идут отдельной очередью
+        self.db_lanes = [
+            DBLane('w{}'.format(idx), self.db_handle_task, self.loop, maxsize=db_queue_size,
+                   spill=self._db_task_spill)
+            for idx in range(max(1, db_workers))
+        ]
+        self.db_reload_lane = DBLane('reload', self.db_handle_task, self.loop, maxsize=db_queue_size)
+        self.maps = LeaseCache()
+        self.maps_staging = {}  # MAC (int) -> relay IP (int)
+        self.staging_ttl = staging_ttl
+        self.staging_timers = TimerWheel(self._expire_staging, tick=max(1.0, staging_ttl / 512), loop=self.loop)
+        # то, что не удалось записать в БД, уходит в журнал и проигрывается позже
+        if journal_dir:
+            self.journal = Journal(journal_dir, fsync_interval=journal_fsync_interval, loop=self.loop)
+            self.journal.open()
+        else:
+            self.journal = None
+        self.journal_replay_interval = journal_replay_interval
+        self._replay_attempts = {}
+        self.lease_batchers = [
+            Batcher(partial(self._flush_leases, lane), size=lease_flush_size,
+                    interval=lease_flush_interval, loop=self.loop)
+            for lane in self.db_lanes
+        ]
+        self.staging_batchers = [
+            Batcher(partial(self._flush_staging, lane), size=staging_flush_size,
+                    interval=staging_flush_interval, loop=self.loop)
+            for lane in self.db_lanes
+        ]
+        self.counters = Counter()
+        self._unknown_relays = {}
+        # пока кэш загружается, неизвестные MAC не отправляются в staging, а откладываются здесь
+        self.is_loading = True
+        self.loaded = asyncio.Event(loop=loop)
+        self._deferred_staging = {}
 
         future = self.db_task_handling_loop()
-        asyncio.ensure_future(future, loop=self.loop)
+        self._db_future = asyncio.ensure_future(future, loop=self.loop)
         future = self.db_channel_handling_loop()
         asyncio.ensure_future(future, loop=self.loop)
+        if self.stats_interval:
+            future = self.stats_logging_loop()
+            self._stats_future = asyncio.ensure_future(future, loop=self.loop)
+        else:
+            self._stats_future = None
+        if self.snapshot_file and self.snapshot_interval:
+            future = self.snapshot_saving_loop()
+            self._snapshot_future = asyncio.ensure_future(future, loop=self.loop)
+        else:
+            self._snapshot_future = None
+        if self.reconcile_interval:
+            future = self.reconcile_loop()
+            self._reconcile_future = asyncio.ensure_future(future, loop=self.loop)
+        else:
+            self._reconcile_future = None
+        if self.journal is not None:
+            future = self.journal_replay_loop()
+            self._replay_future = asyncio.ensure_future(future, loop=self.loop)
+        else:
+            self._replay_future = None
         self.is_stoping = False
 
     async def stop(self):
         self.logger.info('Started grace shutdown...')
         self.is_stoping = True
-        await self.db_tasks.put((DBTask.SHUTDOWN, None))
+        if self._stats_future:
+            self._stats_future.cancel()
+        if self._snapshot_future:
+            self._snapshot_future.cancel()
+        if self._replay_future:
+            self._replay_future.cancel()
+        if self._reconcile_future:
+            self._reconcile_future.cancel()
+        if self.snapshot_file and not self.is_loading:
+            self.save_snapshot()
+        for batcher in self.lease_batchers + self.staging_batchers:
+            batcher.flush()
+        for lane in self.db_lanes + [self.db_reload_lane]:
+            lane.closing = True
+            await lane.put((DBTask.SHUTDOWN, None))
+        done, pending = await asyncio.wait([self._db_future], timeout=self.SHUTDOWN_TIMEOUT, loop=self.loop)
+        if pending:
+            self.logger.error('db tasks are not finished in %ds', self.SHUTDOWN_TIMEOUT)
+            self._db_future.cancel()
+            for lane in self.db_lanes:
+                lane.spill_queued()
+        if self.journal is not None:
+            self.journal.close()
 
-    async def handle_request(self, request, address, listener):
+    def stats(self):
+        stats = super().stats()
+        stats.update(self.counters)
+        for batcher in self.lease_batchers:
+            _merge_stats(stats, batcher.stats, 'lease_')
+        for batcher in self.staging_batchers:
+            _merge_stats(stats, batcher.stats, 'staging_')
+        for lane in self.db_lanes + [self.db_reload_lane]:
+            prefix = 'db_{}_'.format(lane.name)
+            _merge_stats(stats, lane.stats, prefix)
+            stats[prefix + 'depth'] = lane.queue.qsize()
+        if self.journal is not None:
+            _merge_stats(stats, self.journal.stats, 'journal_')
+        stats['staging_pending'] = len(self.maps_staging)
+        if self.replies is not None:
+            _merge_stats(stats, self.replies.stats, 'reply_cache_')
+        if self.admission is not None:
+            _merge_stats(stats, self.admission.stats, 'admission_')
+        stats['db_backlog'] = self.db_backlog()
+        stats['channel_reconnects'] = self.channel.reconnects
+        return stats
+
+    def _format_stats(self, stats):
+        parts = ['{}={}'.format(key, round(value, 1) if isinstance(value, float) else value)
+                 for key, value in sorted(stats.items())]
+        if stats['lease_flushed']:
+            parts.append('lease_coalescing={:.2f}'.format(stats['lease_added'] / stats['lease_flushed']))
+        if stats['lease_flushes']:
+            parts.append('lease_flush_ms_avg={:.1f}'.format(
+                stats['lease_flush_ms_total'] / stats['lease_flushes']))
+        return ' '.join(parts)
+
+    async def stats_logging_loop(self):
+        try:
+            while True:
+                await asyncio.sleep(self.stats_interval, loop=self.loop)
+                self.logger.info('stats: %s', self._format_stats(self.stats()))
+                if self.admission is not None:
+                    top = self.admission.top_shed()
+                    if top:
+                        self.logger.info('shed by relay: %s', ' '.join(
+                            '{}={}'.format(ipaddress.IPv4Address(relay_ip), dict(stats))
+                            for relay_ip, stats in top))
+        except asyncio.CancelledError:
+            pass
+
+    def handle_request_nowait(self, request, address, listener):
         if self.is_stoping:
             return None
 
@@ -190,155 +701,643 @@ class DHCPServer(AsyncServer):
             # обрабатывать только запросы с релеев
             return None
 
-        relay_ip = request.giaddr or ipaddress.IPv4Address(address)
-        self.logger.info('%s %s from relay: %s', request.chaddr, request.message_type.name, relay_ip)
-        circuit_id = (request.get_circuit_id() or b'').decode('utf-8')
+        relay_ip = request.giaddr_int or ip_to_int(address[0])
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # строки и IPv4Address на каждый пакет строятся только при отладке
+            self.logger.debug('%s %s from relay: %s', request.chaddr, request.message_type.name,
+                              ipaddress.IPv4Address(relay_ip))
 
-        if request.chaddr in self.maps:
-            profile = self.maps[request.chaddr]
-            if profile['relay_ip'] != relay_ip and request.chaddr not in self.maps_staging:
-                self.db_task_add_staging(request.chaddr, relay_ip, circuit_id)
-                return None
-        elif request.chaddr in self.maps_staging:
+        admission = self.admission
+        if admission is not None and not admission.admit(relay_ip, request.chaddr_int, time.monotonic()):
+            return None
+
+        reply = self._answer_cached(request, relay_ip, listener)
+        if reply is self.DEFER and admission is not None and admission.saturated(self.db_backlog()):
+            # при перегрузке БД отбрасываются только запросы, которым нужна запись в БД (новые MAC,
+            # смена релея); известные MAC обслуживаются из кэша как обычно
+            admission.shed(relay_ip, 'backlog')
+            return None
+        return reply
+
+    def db_backlog(self):
+        ''' Задачи, ждущие записи в БД: очереди DBLane и ещё не сброшенные пачки staging. '''
+        return (sum(lane.queue.qsize() for lane in self.db_lanes)
+                + sum(len(batcher) for batcher in self.staging_batchers))
+
+    def _answer_cached(self, request, relay_ip, listener):
+        mac = request.chaddr_int
+        item = self.maps.get(mac)
+        if item is not None and item[2] not in self.maps.profiles:
+            # профиль удалён вместе с владельцами (ON DELETE CASCADE), запись устарела
+            self.maps.remove(mac)
+            item = None
+        if item is not None:
+            if self.maps.profiles[item[2]].relay_ip != relay_ip and mac not in self.maps_staging:
+                return self.DEFER
+            if self.replies is not None:
+                # повтор уже отвеченного запроса: тот же ответ, без новой записи в БД
+                key = mac, request.xid, request.message_type, relay_ip
+                now = time.monotonic()
+                reply = self.replies.get(key, now)
+                if reply is None:
+                    reply = self.make_reply(request, item, relay_ip, listener)
+                    self.replies.put(key, reply, now)
+                return reply
+        elif mac in self.maps_staging:
             self.logger.debug('%s is awaiting resolution, ignore request', request.chaddr)
             return None
+        elif relay_ip not in self.maps.relays and not self.is_loading:
+            self._reject_unknown_relay(relay_ip)
+            return None
         else:
-            self.db_task_add_staging(request.chaddr, relay_ip, circuit_id)
+            return self.DEFER
+
+        return self.make_reply(request, item, relay_ip, listener)
+
+    async def handle_request(self, request, address, listener):
+        # сюда попадают только промахи кэша: MAC ещё неизвестен или сменил релей
+        relay_ip = request.giaddr_int or ip_to_int(address[0])
+        reply = self._answer_cached(request, relay_ip, listener)
+        if reply is not self.DEFER:
+            return reply
+
+        circuit_id = circuit_id_text(request.get_circuit_id())
+        if self.is_loading:
+            # запись может быть ещё не загружена, решим после загрузки
+            self._deferred_staging[request.chaddr_int] = (relay_ip, circuit_id)
             return None
+        self.db_task_add_staging(request.chaddr_int, relay_ip, circuit_id)
+        return None
 
+    def make_reply(self, request, item, relay_ip, listener):
+        owner_id, ip_addr, profile_id = item
         server_addr = listener.server_addr or self.default_server_addr
-        pkt = request.make_reply(server_addr, profile['ip_addr'])
-        if pkt.message_type == MessageType.ACK:
-            self.db_task_update_lease(request.chaddr, relay_ip)
-
-        pkt.add_option(OptionType.SubnetMask, profile['netmask'])
-        if profile.get('router_ip'):
-            pkt.add_option(OptionType.Router, profile['router_ip'])
-        if profile.get('dns_ips'):
-            pkt.add_option(OptionType.DomainNameServers, profile['dns_ips'])
-        if profile.get('ntp_ips'):
-            pkt.add_option(OptionType.NTPServer, profile['ntp_ips'])
-        lease_time = int(profile['lease_time'].total_seconds())
-        pkt.add_option(OptionType.IPaddressLeaseTime, lease_time)
-        if server_addr:
-            pkt.add_option(OptionType.ServerIdentifier, server_addr)
-
-        for option in request._options:
-            if option.type not in (
-                    OptionType.DHCPMessageType, OptionType.RequestedIPaddress,
-                    OptionType.ParameterRequestList, OptionType.Pad):
-                pkt._options.append(option)
-        return pkt
+        profile = self.maps.profiles[profile_id]
+        if request.message_type == MessageType.DISCOVER:
+            message_type = MessageType.OFFER
+        else:
+            message_type = MessageType.ACK
+            # lease_date в БД отстаёт от последнего продления не больше чем на lease_refresh * lease_time
+            refresh = profile.lease_time.total_seconds() * self.lease_refresh
+            if self.maps.renew_lease(request.chaddr_int, int(time.time()), refresh):
+                self.db_task_update_lease(owner_id)
+            else:
+                self.counters['lease_renew_skipped'] += 1
+        reply = request.pack_reply(
+            message_type, ip_addr, ip_to_int(server_addr or '0.0.0.0'),
+            profile.reply_options(server_addr))
+        if not self._first_reply_sent:
+            self._first_reply_sent = True
+            self.logger.info('first reply sent %.3fs after start', time.monotonic() - self._started)
+        return reply
+
+    def _reject_unknown_relay(self, relay_ip):
+        self.counters['unknown_relay'] += 1
+        now = time.monotonic()
+        if now - self._unknown_relays.get(relay_ip, -self.UNKNOWN_RELAY_WARN_INTERVAL) \
+                >= self.UNKNOWN_RELAY_WARN_INTERVAL:
+            if len(self._unknown_relays) > 10000:
+                self._unknown_relays.clear()
+            self._unknown_relays[relay_ip] = now
+            self.logger.warning('no profile for relay %s', ipaddress.IPv4Address(relay_ip))
 
     def db_task_add_staging(self, macaddr, relay_ip, circuit_id):
+        profile_id = self.maps.relays.get(relay_ip)
+        if profile_id is None:
+            self._reject_unknown_relay(relay_ip)
+            return
+        self._stage(macaddr, relay_ip)
+        batcher = self.staging_batchers[macaddr % len(self.staging_batchers)]
+        batcher.add(macaddr, (profile_id, circuit_id))
+
+    def _flush_staging(self, lane, items):
+        if lane.put_nowait((DBTask.ADD_STAGING, items)):
+            return True
+        if self._db_task_spill(DBTask.ADD_STAGING, items):
+            return True
+        self.logger.warning('db lane %s is not available, staging inserts are kept for the next flush', lane.name)
+        return False
+
+    def db_task_update_lease(self, owner_id):
+        # повторные продления одного владельца до сброса пачки схлопываются в одно
+        batcher = self.lease_batchers[owner_id % len(self.lease_batchers)]
+        batcher.add(owner_id, datetime.now())
+
+    def _flush_leases(self, lane, leases):
+        params = (leases, time.monotonic())
+        if lane.put_nowait((DBTask.UPDATE_LEASE, params)):
+            return True
+        if self._db_task_spill(DBTask.UPDATE_LEASE, params):
+            return True
+        self.logger.warning('db lane %s is not available, lease updates are kept for the next flush', lane.name)
+        return False
+
+    def _db_task_spill(self, task, params):
+        ''' Сохраняет задачу записи в журнал. Возвращает False, если журнала нет. '''
+        if self.journal is None:
+            return False
+        if task is DBTask.UPDATE_LEASE:
+            leases, flushed_at = params
+            self.journal.append('lease', [[owner_id, date.timestamp()] for owner_id, date in leases.items()])
+        elif task is DBTask.ADD_STAGING:
+            self.journal.append('staging', [[mac, profile_id, circuit_id]
+                                            for mac, (profile_id, circuit_id) in params.items()])
+        else:
+            return False
+        return True
+
+    async def journal_replay_loop(self):
         try:
-            task = DBTask.ADD_STAGING, (datetime.now(), macaddr, relay_ip, circuit_id)
-            self.db_tasks.put_nowait(task)
-            self.maps_staging[macaddr] = relay_ip
-        except asyncio.QueueFull:
-            self.logger.warning('db tasks queue is full, new task droped')
+            await self.loaded.wait()
+            while True:
+                await asyncio.sleep(self.journal_replay_interval, loop=self.loop)
+                if all(lane.connected for lane in self.db_lanes) and self.journal.pending():
+                    await self.db_replay_journal()
+        except asyncio.CancelledError:
+            pass
 
-    def db_task_update_lease(self, macaddr, relay_ip):
+    async def db_replay_journal(self):
+        ''' Проигрывает закрытые сегменты журнала и удаляет их после коммита.
+
+        Записи сегмента схлопываются: для владельца остаётся самая поздняя дата аренды.
+        Порядок относительно текущих записей не важен — обновление аренды не перезаписывает
+        более позднюю дату, а вставка в staging пропускает существующие MAC.
+        '''
+        self.journal.rotate()
+        conn = path = None
         try:
-            task = DBTask.UPDATE_LEASE, (datetime.now(), macaddr, relay_ip)
-            self.db_tasks.put_nowait(task)
-        except asyncio.QueueFull:
-            self.logger.warning('db tasks queue is full, new task droped')
+            async with self.db.acquire() as conn:
+                for path in self.journal.sealed():
+                    leases, staging = {}, {}
+                    for kind, payload in self.journal.read(path):
+                        if kind == 'lease':
+                            for owner_id, ts in payload:
+                                date = datetime.fromtimestamp(ts)
+                                if owner_id not in leases or leases[owner_id] < date:
+                                    leases[owner_id] = date
+                        elif kind == 'staging':
+                            for mac, profile_id, circuit_id in payload:
+                                staging[mac] = (profile_id, circuit_id)
+                    started = time.monotonic()
+                    async with conn.begin():
+                        for chunk in _chunks(leases, self.lease_batchers[0].size):
+                            await self.db_handle_task(conn, DBTask.UPDATE_LEASE, (chunk, started))
+                        for chunk in _chunks(staging, self.staging_batchers[0].size):
+                            await self.db_handle_task(conn, DBTask.ADD_STAGING, chunk)
+                    self.journal.remove(path)
+                    self._replay_attempts.pop(path, None)
+                    self.logger.info('replayed journal %s: %d leases, %d staging in %.2fs',
+                                     path, len(leases), len(staging), time.monotonic() - started)
+        except Exception as e:
+            self.counters['journal_replay_failed'] += 1
+            if path is None or conn.closed:
+                self.logger.error('journal replay failed, will retry: %s', e)
+                return
+            attempts = self._replay_attempts.get(path, 0) + 1
+            if attempts < self.JOURNAL_REPLAY_ATTEMPTS:
+                self._replay_attempts[path] = attempts
+                self.logger.error('journal %s replay failed, will retry: %s', path, e)
+            else:
+                # сегмент, который не принимает БД, не должен блокировать следующие
+                self._replay_attempts.pop(path, None)
+                self.journal.discard(path)
+                self.logger.error('journal %s replay failed %d times, moved aside: %s', path, attempts, e)
 
     async def db_task_handling_loop(self):
-        async with self.db.acquire() as conn:
-            while True:
-                task, params = await self.db_tasks.get()
-                self.logger.info('handling db task: %s', task.name)
-                if task is DBTask.SHUTDOWN:
-                    break
-                elif task is DBTask.ADD_STAGING:
-                    date, mac_addr, relay_ip, circuit_id = params
-                    try:
-                        res = await (await conn.execute(
-                            db.owner.insert().from_select(
-                                ['mac_addr', 'profile_id', 'description'],
-                                sa.select([
-                                    sa.literal(mac_addr),
-                                    db.profile.c.id,
-                                    sa.literal(circuit_id),
-                                ]).
-                                select_from(db.profile).
-                                where(db.profile.c.relay_ip == str(relay_ip))
-                            ).returning(db.owner.c.id)
-                        )).fetchone()
-                        if not res:
-                            del self.maps_staging[mac_addr]
-                            self.logger.warning('no profile for relay %s', relay_ip)
-                    except psycopg2.IntegrityError:
-                        pass
-                elif task is DBTask.UPDATE_LEASE:
-                    date, macaddr, relay_ip = params
-                    item = self.maps.get(macaddr)
-                    if item:
-                        await conn.execute(
-                            db.owner.update().
-                            values(lease_date=date).
-                            where(db.owner.c.id == item['id'])
-                        )
-                elif task is DBTask.REMOVE_ACTIVE:
-                    mac_addr, = params
-                    del self.maps[mac_addr]
-                elif task is DBTask.REMOVE_STAGING:
-                    mac_addr, = params
-                    del self.maps_staging[mac_addr]
-                elif task is DBTask.RELOAD_ITEM:
-                    item_id, = params
-                    item = await (await conn.execute(
-                        self.sql_select_owner.where(db.owner.c.id == item_id)
-                    )).fetchone()
-                    self._update_item(item)
-                elif task is DBTask.RELOAD_PROFILE:
-                    profile_id, = params
-                    items = await conn.execute(
-                        self.sql_select_owner.
-                            where(db.owner.c.profile_id == profile_id).
-                            order_by(sa.asc(db.owner.c.modify_date))
-                    )
-                    async for item in items:
-                        self._update_item(item)
+        lanes = self.db_lanes + [self.db_reload_lane]
+        maxsize = getattr(self.db, 'maxsize', None)
+        if maxsize is not None and maxsize < len(lanes) + 1:
+            self.logger.warning('db pool maxsize=%d is less than %d db lanes plus one for loading, '
+                                'lanes will wait for connections', maxsize, len(lanes))
+        await asyncio.gather(*[lane.run(self.db) for lane in lanes], loop=self.loop)
 
         self.db.close()
         await self.db.wait_closed()
 
+    async def db_handle_task(self, conn, task, params):
+        if self.replies is not None and task in (DBTask.RELOAD, DBTask.REMOVE_ACTIVE, DBTask.RESYNC):
+            # ответы, собранные по прежним данным, больше не годятся
+            self.replies.clear()
+        if task is DBTask.ADD_STAGING:
+            try:
+                await self._db_add_staging(conn, params)
+            except Exception:
+                if self.journal is None:
+                    # MAC не попали в БД, следующий запрос с них снова поставит вставку
+                    for mac in params:
+                        self.maps_staging.pop(mac, None)
+                raise
+        elif task is DBTask.UPDATE_LEASE:
+            leases, flushed_at = params
+            # одинаковый порядок блокировок строк у всех воркеров исключает взаимоблокировки;
+            # условие на дату не даёт перезаписать строку более старым значением
+            ids = sorted(leases)
+            started = time.monotonic()
+            await conn.execute(self.sql_update_leases, ids=ids, dates=[leases[i] for i in ids])
+            finished = time.monotonic()
+            flush_ms = (finished - started) * 1000
+            self.counters['lease_flush_ms_total'] += flush_ms
+            self.counters['lease_flush_ms_max'] = max(self.counters['lease_flush_ms_max'], flush_ms)
+            self.counters['lease_flush_wait_ms_max'] = max(
+                self.counters['lease_flush_wait_ms_max'], (started - flushed_at) * 1000)
+        elif task is DBTask.REMOVE_ACTIVE:
+            for mac_addr in params:
+                self.maps.remove(mac_addr)
+        elif task is DBTask.REMOVE_STAGING:
+            for mac_addr in params:
+                self.maps_staging.pop(mac_addr, None)
+        elif task is DBTask.RELOAD:
+            item_ids, profile_ids = params
+            for profile_id in sorted(profile_ids):
+                await self._db_reload_profile(conn, profile_id)
+            if item_ids:
+                items = await conn.execute(
+                    self.sql_select_owner.
+                        where(db.owner.c.id == sa.any_(_int_array(item_ids))).
+                        order_by(sa.asc(db.owner.c.modify_date))
+                )
+                async for item in items:
+                    self._update_item(item)
+        elif task is DBTask.RESYNC:
+            await self._db_load_changes(conn, params)
+            await conn.execute(db.owner_deleted.delete().where(
+                db.owner_deleted.c.delete_date < sa.func.now() - timedelta(seconds=self.TOMBSTONE_RETENTION)))
+            self.counters['resyncs'] += 1
+
+    async def _db_reload_profile(self, conn, profile_id):
+        ''' Заменяет общую для всех владельцев запись профиля, сами владельцы не перечитываются:
+        они ссылаются на профиль по id, а смена владельцев приходит перезагрузками записей.
+        '''
+        row = await (await conn.execute(
+            db.profile.select().where(db.profile.c.id == profile_id)
+        )).fetchone()
+        started = time.monotonic()
+        if row is None:
+            self.maps.remove_profile(profile_id)
+        else:
+            self.maps.set_profile(Profile.from_row(row))
+            self._advance_watermark(row.modify_date)
+        # сколько цикл событий был занят заменой профиля
+        stall_ms = (time.monotonic() - started) * 1000
+        self.counters['profile_reloads'] += 1
+        self.counters['profile_reload_ms_max'] = max(self.counters['profile_reload_ms_max'], stall_ms)
+
+    async def _db_add_staging(self, conn, items):
+        # вставка в порядке id профиля: триггер блокирует строки счётчиков profile_usage
+        # в одном порядке у всех воркеров
+        order = sorted(items, key=lambda mac: (items[mac][0], mac))
+        macs = [int_to_mac(mac) for mac in order]
+        try:
+            inserted = await self._db_insert_staging(conn, order, items)
+        except Exception as e:
+            if conn.closed:
+                raise
+            # одна плохая строка не должна терять всю пачку: вставляем по одной
+            self.logger.warning('staging batch of %d MACs failed (%s), inserting one by one', len(order), e)
+            inserted = set()
+            for mac in order:
+                try:
+                    inserted |= await self._db_insert_staging(conn, [mac], items)
+                except Exception as e:
+                    if conn.closed:
+                        raise
+                    # MAC остаётся в staging кэше до staging_ttl, чтобы не повторять вставку на каждый запрос
+                    self.counters['staging_rejected'] += 1
+                    self.logger.error('staging insert of %s failed: %s', int_to_mac(mac), e)
+        self.counters['staging_inserted'] += len(inserted)
+
+        # для уже существующих записей могло потеряться уведомление, перечитываем их
+        existing = [mac for mac in macs if mac_to_int(mac) not in inserted]
+        # повторная постановка MAC, который уже есть в БД (например, после истечения в staging)
+        self.counters['staging_requeued'] += len(existing)
+        if existing:
+            rows = await (await conn.execute(
+                self.sql_select_owner.
+                    where(db.owner.c.mac_addr.in_(existing)).
+                    order_by(sa.asc(db.owner.c.modify_date))
+            )).fetchall()
+            for item in rows:
+                if items.get(mac_to_int(item.mac_addr), (None,))[0] == item.profile_id:
+                    self._update_item(item)
+
+    async def _db_insert_staging(self, conn, macs, items):
+        # точка сохранения: при проигрывании журнала вставка идёт внутри общей транзакции,
+        # и ошибка не должна обрывать её вместе с арендами; на соединении очереди без
+        # транзакции begin_nested() открывает обычную
+        async with conn.begin_nested():
+            res = await conn.execute(
+                self.sql_insert_staging,
+                macs=[int_to_mac(mac) for mac in macs],
+                profile_ids=[items[mac][0] for mac in macs],
+                descriptions=[items[mac][1] for mac in macs])
+            return {mac_to_int(row.mac_addr) for row in await res.fetchall()}
+
     async def db_load_owners(self):
+        ''' Загружает кэш через серверный курсор порциями по load_chunk строк.
+        Может работать в фоне: между порциями сервер продолжает отвечать из частичного кэша.
+        '''
+        started = time.monotonic()
+        query = self.sql_select_owner.order_by(sa.asc(db.owner.c.modify_date))
+        compiled = query.compile(dialect=self.db.dialect)
+        count = 0
         async with self.db.acquire() as conn:
-            items = await (await conn.execute(
-                self.sql_select_owner.order_by(sa.asc(db.owner.c.modify_date))
-            )).fetchall()
-            for item in items:
-                self._update_item(item)
+            # удаления после этого момента придут через owner_deleted
+            loaded_at = (await conn.scalar(sa.select([sa.func.now()]))).timestamp()
+            profiles = await (await conn.execute(db.profile.select())).fetchall()
+            self.maps.load_profiles(Profile.from_row(row) for row in profiles)
+            for row in profiles:
+                self._advance_watermark(row.modify_date)
+            async with conn.begin():
+                await conn.execute(
+                    'DECLARE owners_load NO SCROLL CURSOR FOR ' + str(compiled), compiled.params)
+                while True:
+                    items = await (await conn.execute(
+                        'FETCH FORWARD {:d} FROM owners_load'.format(self.load_chunk)
+                    )).fetchall()
+                    if not items:
+                        break
+                    for item in items:
+                        self._update_item(item)
+                    count += len(items)
+                    self.logger.info('loading owners: %d rows, %.1fs', count, time.monotonic() - started)
+                    # даём циклу обработать накопившиеся запросы
+                    await asyncio.sleep(0, loop=self.loop)
+                await conn.execute('CLOSE owners_load')
+        self.tombstone_mark = loaded_at
+
+        self.logger.info('loaded %d rows in %.1fs', count, time.monotonic() - started)
+        if self.maps:
+            self.logger.info('loaded %d owners, %d awaiting resolution, %.1f bytes per cache entry',
+                             len(self.maps), len(self.maps_staging),
+                             self.maps.memory_usage() / len(self.maps))
+        self._finish_loading()
+
+    async def db_warm_up(self):
+        ''' Заполняет кэш из снимка на диске и догружает изменения после него.
+        Если снимка нет или он испорчен/устарел — полная загрузка db_load_owners().
+        '''
+        if self.snapshot_file:
+            started = time.monotonic()
+            try:
+                watermark = snapshot.read(self.snapshot_file, self.maps, self.maps_staging,
+                                          self.snapshot_max_age)
+            except snapshot.SnapshotError as e:
+                self.logger.warning('snapshot %s is not used: %s', self.snapshot_file, e)
+            else:
+                self.watermark = watermark
+                if self.staging_ttl:
+                    for mac in self.maps_staging:
+                        self.staging_timers.schedule(mac, self.staging_ttl)
+                self.logger.info('loaded snapshot: %d owners, %d awaiting resolution in %.1fs',
+                                 len(self.maps), len(self.maps_staging), time.monotonic() - started)
+                await self.db_load_changes()
+                self._finish_loading()
+                return
+        await self.db_load_owners()
+
+    async def db_load_changes(self):
+        async with self.db.acquire() as conn:
+            await self._db_load_changes(conn)
+
+    async def _db_load_changes(self, conn, since=None):
+        ''' Догружает строки, изменённые после watermark, и удаляет из кэша удалённые.
+        since (unix time) сдвигает границу назад: пакетная загрузка помечает строки временем начала
+        своей транзакции, которое может оказаться раньше watermark.
+        '''
+        started = time.monotonic()
+        watermark = self.watermark or 0
+        if since is not None:
+            watermark = min(watermark, since)
+        since = datetime.fromtimestamp(watermark - self.WATERMARK_MARGIN, timezone.utc)
+        # удаления читаются от прошлого чтения owner_deleted: watermark без изменений стоит на месте
+        deleted_since = watermark if self.tombstone_mark is None else self.tombstone_mark
+        now = (await conn.scalar(sa.select([sa.func.now()]))).timestamp()
+        count = 0
+        profiles = await (await conn.execute(
+            db.profile.select().where(db.profile.c.modify_date > since)
+        )).fetchall()
+        for row in profiles:
+            self.maps.set_profile(Profile.from_row(row))
+            self._advance_watermark(row.modify_date)
+        await self._drop_deleted_profiles(conn)
+
+        full_diff = deleted_since < now - self.TOMBSTONE_RETENTION
+        if not full_diff:
+            # удаления раньше изменений: строка, удалённая и созданная заново, остаётся в кэше
+            await self._drop_tombstones(conn, deleted_since - self.WATERMARK_MARGIN)
+
+        items = await conn.execute(
+            self.sql_select_owner.
+                where(db.owner.c.modify_date > since).
+                order_by(sa.asc(db.owner.c.modify_date))
+        )
+        async for item in items:
+            self._update_item(item)
+            count += 1
+
+        if full_diff:
+            # часть удалений уже вычищена из owner_deleted (например, снимок слишком старый)
+            await self._drop_deleted(conn)
+        self.tombstone_mark = now
+        self.logger.info('loaded %d changed profiles, %d changed owners in %.1fs',
+                         len(profiles), count, time.monotonic() - started)
+
+    async def _drop_deleted_profiles(self, conn):
+        profile_ids = {row.id for row in await (await conn.execute(
+            sa.select([db.profile.c.id])
+        )).fetchall()}
+        for profile_id in set(self.maps.profiles) - profile_ids:
+            self.maps.remove_profile(profile_id)
+
+    async def _drop_tombstones(self, conn, since):
+        rows = await (await conn.execute(
+            sa.select([db.owner_deleted.c.owner_id, db.owner_deleted.c.mac_addr]).
+            where(db.owner_deleted.c.delete_date > datetime.fromtimestamp(since, timezone.utc))
+        )).fetchall()
+        removed = removed_staging = 0
+        for row in rows:
+            if row.mac_addr is None:
+                continue
+            mac = mac_to_int(row.mac_addr)
+            item = self.maps.get(mac)
+            if item is not None:
+                # MAC мог уже получить новую запись с другим id
+                if item[0] == row.owner_id:
+                    self.maps.remove(mac)
+                    removed += 1
+            elif self.maps_staging.pop(mac, None) is not None:
+                removed_staging += 1
+        if removed or removed_staging:
+            self.logger.info('dropped %d deleted owners, %d deleted staging entries',
+                             removed, removed_staging)
+
+    async def _drop_deleted(self, conn):
+        ''' Полная сверка кэша с таблицей owner, порциями по FULL_DIFF_CHUNK записей с передачей
+        управления циклу между ними.
+        '''
+        owner_ids = {row.id for row in await (await conn.execute(
+            sa.select([db.owner.c.id]).where(db.owner.c.ip_addr != None)
+        )).fetchall()}
+        # записи, добавленные в кэш во время сверки, моложе прочитанных id и не трогаются
+        max_id = max(owner_ids, default=0)
+        macs = self.maps.macs()
+        removed = 0
+        for start in range(0, len(macs), self.FULL_DIFF_CHUNK):
+            for mac in macs[start:start + self.FULL_DIFF_CHUNK]:
+                item = self.maps.get(mac)
+                if item is not None and item[0] <= max_id and item[0] not in owner_ids:
+                    self.maps.remove(mac)
+                    removed += 1
+            await asyncio.sleep(0, loop=self.loop)
+
+        staging_macs = {mac_to_int(row.mac_addr) for row in await (await conn.execute(
+            sa.select([db.owner.c.mac_addr]).where(db.owner.c.ip_addr == None)
+        )).fetchall()}
+        removed_staging = [mac for mac in self.maps_staging if mac not in staging_macs]
+        for mac in removed_staging:
+            del self.maps_staging[mac]
+        self.counters['full_diffs'] += 1
+        self.logger.info('full diff: dropped %d deleted owners, %d deleted staging entries',
+                         removed, len(removed_staging))
+
+    def save_snapshot(self):
+        started = time.monotonic()
+        try:
+            snapshot.write(self.snapshot_file, self.maps, self.maps_staging, self.watermark)
+        except OSError as e:
+            self.logger.error('can not write snapshot %s: %s', self.snapshot_file, e)
+            return
+        self.logger.info('snapshot saved: %d owners in %.2fs', len(self.maps), time.monotonic() - started)
+
+    async def reconcile_loop(self):
+        ''' Периодически догружает изменения на случай пропущенных уведомлений. '''
+        try:
+            await self.loaded.wait()
+            while True:
+                await asyncio.sleep(self.reconcile_interval, loop=self.loop)
+                await self.db_reload_lane.put((DBTask.RESYNC, None))
+        except asyncio.CancelledError:
+            pass
+
+    async def snapshot_saving_loop(self):
+        try:
+            await self.loaded.wait()
+            while True:
+                await asyncio.sleep(self.snapshot_interval, loop=self.loop)
+                self.save_snapshot()
+        except asyncio.CancelledError:
+            pass
+
+    def _advance_watermark(self, date):
+        if date is None:
+            return
+        value = date.timestamp()
+        if self.watermark is None or value > self.watermark:
+            self.watermark = value
+
+    def _finish_loading(self):
+        self.is_loading = False
+        self.loaded.set()
+        deferred, self._deferred_staging = self._deferred_staging, {}
+        for mac, (relay_ip, circuit_id) in deferred.items():
+            if mac not in self.maps and mac not in self.maps_staging:
+                self.db_task_add_staging(mac, relay_ip, circuit_id)
+        if deferred:
+            self.logger.info('%d requests deferred while loading', len(deferred))
 
     def _update_item(self, item):
+        self._advance_watermark(item.modify_date)
+        self._advance_watermark(item.profile_modify_date)
+        if item.profile_id not in self.maps.profiles:
+            self.maps.set_profile(Profile.from_row(item, 'profile_id'))
+        mac = mac_to_int(item.mac_addr)
         if item.ip_addr:
-            if item.mac_addr in self.maps_staging:
-                del self.maps_staging[item.mac_addr]
-            self.maps[item.mac_addr] = dict(item)
-            self.maps[item.mac_addr]['netmask'] = item.network_addr.with_netmask.split('/')[1]
+            self.maps_staging.pop(mac, None)
+            lease_date = int(item.lease_date.timestamp()) if item.lease_date else 0
+            self.maps.set(mac, item.id, int(item.ip_addr), item.profile_id, lease_date)
         else:
-            self.maps_staging[item.mac_addr] = item.relay_ip
+            item_cached = self.maps.get(mac)
+            if item_cached is not None and item_cached[0] == item.id:
+                # адрес снят, владелец вернулся в staging
+                self.maps.remove(mac)
+            self._stage(mac, int(item.relay_ip))
+
+    def _stage(self, mac, relay_ip):
+        self.maps_staging[mac] = relay_ip
+        if self.staging_ttl:
+            self.staging_timers.schedule(mac, self.staging_ttl)
+
+    def _expire_staging(self, macs):
+        # запись могла потеряться (не удалась вставка, пропало уведомление) — забываем MAC,
+        # и следующий запрос с него снова поставит вставку и перечитает строку
+        expired = 0
+        for mac in macs:
+            if self.maps_staging.pop(mac, None) is not None:
+                expired += 1
+        self.counters['staging_expired'] += expired
 
     async def db_channel_handling_loop(self):
+        # изменения применяем поверх полностью загруженного кэша, иначе их перезапишут
+        # более старые строки из курсора загрузки
+        await self.loaded.wait()
+        # перезагрузки копятся reload_debounce секунд и уходят одной задачей
+        deadline = None
         while True:
-            msg = await self.channel.queue.get()
+            try:
+                if deadline is None:
+                    msg = await self.channel.queue.get()
+                else:
+                    msg = await asyncio.wait_for(
+                        self.channel.queue.get(), max(0, deadline - self.loop.time()), loop=self.loop)
+            except asyncio.TimeoutError:
+                await self._flush_reloads()
+                deadline = None
+                continue
             if msg is None:
+                await self._flush_reloads()
                 break
+            if msg is self.channel.RECONNECTED:
+                # уведомления за время обрыва потеряны
+                await self.db_reload_lane.put((DBTask.RESYNC, None))
+                continue
+
             self.logger.info('got channel msg: %s', msg.payload)
-            action, param = msg.payload.split(' ', 1)
-            if action == 'RELOAD_ITEM':
-                item_id = int(param)
-                task = DBTask[action], (item_id,)
-                await self.db_tasks.put(task)
-            elif action in ('REMOVE_STAGING', 'REMOVE_ACTIVE'):
-                mac_addr = param.lower()
-                task = DBTask[action], (mac_addr,)
-                await self.db_tasks.put(task)
-            elif action == 'RELOAD_PROFILE':
-                profile_id = int(param)
-                task = DBTask[action], (profile_id,)
-                await self.db_tasks.put(task)
+            try:
+                action, param = msg.payload.split(' ', 1)
+                values = param.split(',')
+                if action in ('RELOAD_ITEM', 'RELOAD_ITEMS'):
+                    self._reload_items.update(int(value) for value in values)
+                elif action == 'RELOAD_PROFILE':
+                    self._reload_profiles.update(int(value) for value in values)
+                elif action == 'RESYNC':
+                    since = float(values[0])
+                    await self._flush_reloads()
+                    deadline = None
+                    await self.db_reload_lane.put((DBTask.RESYNC, since))
+                    continue
+                elif action in ('REMOVE_STAGING', 'REMOVE_ACTIVE'):
+                    macs = [mac_to_int(value) for value in values]
+                    # удаление не должно обогнать поставленные раньше перезагрузки
+                    await self._flush_reloads()
+                    deadline = None
+                    await self.db_reload_lane.put((DBTask[action], macs))
+                    continue
+                else:
+                    self.logger.warning('unknown channel command: %s', action)
+                    continue
+            except ValueError:
+                self.logger.warning('malformed channel msg: %s', msg.payload)
+                continue
+
+            if len(self._reload_items) >= self.RELOAD_BATCH_MAX:
+                await self._flush_reloads()
+                deadline = None
+            elif deadline is None:
+                deadline = self.loop.time() + self.reload_debounce
+
+    async def _flush_reloads(self):
+        if not self._reload_items and not self._reload_profiles:
+            return
+        task = DBTask.RELOAD, (self._reload_items, self._reload_profiles)
+        self._reload_items, self._reload_profiles = set(), set()
+        await self.db_reload_lane.put(task)
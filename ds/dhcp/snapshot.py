@@ -0,0 +1,130 @@
+''' Снимок кэша DHCP сервера на диске.
+
+Формат — заголовок и столбцы фиксированной ширины подряд, файл читается через mmap:
+
+    заголовок (HEADER, дополнен до HEADER_SIZE)
+    mac[n] (u64), owner_id[n] (i32), ip[n] (u32), profile_id[n] (i32), lease_date[n] (u32)
+    staging_mac[m] (u64), staging_relay[m] (u32)
+    профили в JSON
+
+Все числа little-endian. crc32 считается по всему, что идёт после заголовка.
+'''
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import zlib
+import logging
+from array import array
+
+from .cache import Profile
+
+
+MAGIC = b'DSSNAP\0\0'
+VERSION = 2
+# magic, version, watermark, created, slots, staging, profiles json size, crc32
+HEADER = struct.Struct('<8sIddIIII')
+HEADER_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotError(Exception): pass
+
+
+def _column(typecode, values):
+    col = array(typecode, values)
+    if sys.byteorder != 'little':
+        col.byteswap()
+    return col
+
+
+def _read_column(typecode, data):
+    col = array(typecode)
+    col.frombytes(data)
+    if sys.byteorder != 'little':
+        col.byteswap()
+    return col
+
+
+def write(path, cache, staging, watermark):
+    macs, owner_ids, ips, profile_ids, lease_dates = cache.dump_columns()
+    staging_macs = _column('Q', staging.keys())
+    staging_relays = _column('I', staging.values())
+    profiles = json.dumps([p.to_dict() for p in cache.profiles.values()]).encode('utf-8')
+
+    body = [
+        _column('Q', macs), _column('i', owner_ids), _column('I', ips), _column('i', profile_ids),
+        _column('I', lease_dates), staging_macs, staging_relays, profiles,
+    ]
+    crc = 0
+    for part in body:
+        crc = zlib.crc32(part, crc)
+    header = HEADER.pack(MAGIC, VERSION, watermark or 0.0, time.time(),
+                         len(macs), len(staging_macs), len(profiles), crc)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        for part in body:
+            f.write(part)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read(path, cache, staging, max_age=None):
+    ''' Загружает снимок в cache и staging, возвращает watermark.
+
+    При любой проблеме с файлом бросает SnapshotError, кэш при этом не меняется.
+    '''
+    try:
+        f = open(path, 'rb')
+    except OSError as e:
+        raise SnapshotError('can not open snapshot: {}'.format(e))
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise SnapshotError('can not map snapshot: {}'.format(e))
+        with mm:
+            buf = memoryview(mm)
+            try:
+                if len(buf) < HEADER_SIZE:
+                    raise SnapshotError('snapshot is truncated')
+                magic, version, watermark, created, n, m, profiles_len, crc = HEADER.unpack_from(buf)
+                if magic != MAGIC or version != VERSION:
+                    raise SnapshotError('unknown snapshot format')
+                if max_age is not None and time.time() - created > max_age:
+                    raise SnapshotError('snapshot is stale')
+                size = HEADER_SIZE + n * 24 + m * 12 + profiles_len
+                if len(buf) != size:
+                    raise SnapshotError('snapshot size mismatch')
+                if zlib.crc32(buf[HEADER_SIZE:]) != crc:
+                    raise SnapshotError('snapshot checksum mismatch')
+
+                offset = HEADER_SIZE
+                columns = []
+                for typecode, width, count in (('Q', 8, n), ('i', 4, n), ('I', 4, n), ('i', 4, n),
+                                               ('I', 4, n), ('Q', 8, m), ('I', 4, m)):
+                    columns.append(_read_column(typecode, buf[offset:offset + width * count]))
+                    offset += width * count
+                try:
+                    profiles = json.loads(bytes(buf[offset:offset + profiles_len]).decode('utf-8'))
+                except ValueError as e:
+                    raise SnapshotError('broken profiles in snapshot: {}'.format(e))
+            finally:
+                buf.release()
+
+    try:
+        profiles = [Profile.from_dict(p) for p in profiles]
+    except (KeyError, TypeError, ValueError) as e:
+        raise SnapshotError('broken profiles in snapshot: {}'.format(e))
+
+    cache.load_columns(*columns[:5])
+    cache.load_profiles(profiles)
+    staging.clear()
+    staging.update(zip(columns[5], columns[6]))
+    return watermark
@@ -0,0 +1,83 @@
+import os
+import signal
+import logging
+import time
+
+
+class Supervisor:
+    ''' Запускает несколько процессов-воркеров через fork() и перезапускает упавшие.
+
+    target(idx) выполняется в дочернем процессе и должен работать до получения SIGTERM.
+    '''
+    def __init__(self, workers, target, *, restart_delay=1.0, max_restart_delay=30.0, min_uptime=5.0):
+        self.workers = workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.logger = logging.getLogger(__name__)
+        self._children = {}  # pid -> (idx, start time)
+        self._delays = [restart_delay] * workers
+        self._is_stoping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        for idx in range(self.workers):
+            self._spawn(idx)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if pid not in self._children:
+                continue
+            idx, started = self._children.pop(pid)
+            if self._is_stoping:
+                self.logger.info('worker %d (pid %d) exited', idx, pid)
+                continue
+
+            self.logger.error('worker %d (pid %d) died unexpectedly: %s', idx, pid, self._describe(status))
+            if time.monotonic() - started < self.min_uptime:
+                self._delays[idx] = min(self._delays[idx] * 2, self.max_restart_delay)
+            else:
+                self._delays[idx] = self.restart_delay
+            time.sleep(self._delays[idx])
+            if not self._is_stoping:
+                self._spawn(idx)
+
+        self.logger.info('all workers exited')
+
+    def _spawn(self, idx):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            code = 0
+            try:
+                self.target(idx)
+            except Exception:
+                self.logger.exception('worker %d failed', idx)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self.logger.info('started worker %d (pid %d)', idx, pid)
+        self._children[pid] = (idx, time.monotonic())
+
+    def _handle_stop(self, signum, frame):
+        self.logger.info('got signal %d, stopping workers...', signum)
+        self._is_stoping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    @staticmethod
+    def _describe(status):
+        if os.WIFSIGNALED(status):
+            return 'killed by signal {}'.format(os.WTERMSIG(status))
+        return 'exit code {}'.format(os.WEXITSTATUS(status))
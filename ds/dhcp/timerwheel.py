@@ -0,0 +1,74 @@
+import math
+import time
+import asyncio
+from collections import Counter
+
+
+class TimerWheel:
+    ''' Хэшированное колесо таймеров: ключи раскладываются по slots корзинам с шагом tick секунд.
+
+    Постановка, перестановка и отмена таймера — O(1); за тик просматривается одна корзина,
+    ключи с более поздним сроком (больше одного оборота колеса) остаются в ней.
+    Истёкшие за тик ключи отдаются пачкой в expire(keys).
+    '''
+    def __init__(self, expire, *, tick=1.0, slots=512, loop=None):
+        self.tick = tick
+        self.loop = loop or asyncio.get_event_loop()
+        self.stats = Counter()
+        self._expire = expire
+        self._buckets = [set() for _ in range(slots)]
+        self._due = {}  # ключ -> номер тика, на котором он истекает
+        self._now = self._current_tick()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def _current_tick(self):
+        return int(time.monotonic() / self.tick)
+
+    def schedule(self, key, delay):
+        ''' Ставит (или переставляет) таймер ключа на delay секунд. '''
+        self.cancel(key)
+        if self._timer is None:
+            # колесо стояло, догоняем текущее время без обхода пустых корзин
+            self._now = self._current_tick()
+            self._timer = self.loop.call_later(self.tick, self._advance)
+        due = self._now + max(1, math.ceil(delay / self.tick))
+        self._due[key] = due
+        self._buckets[due % len(self._buckets)].add(key)
+        self.stats['scheduled'] += 1
+
+    def cancel(self, key):
+        due = self._due.pop(key, None)
+        if due is None:
+            return False
+        self._buckets[due % len(self._buckets)].discard(key)
+        return True
+
+    def clear(self):
+        for bucket in self._buckets:
+            bucket.clear()
+        self._due.clear()
+
+    def _advance(self):
+        self._timer = None
+        target = self._current_tick()
+        # после долгой блокировки цикла хватит одного оборота
+        start = max(self._now + 1, target - len(self._buckets) + 1)
+        expired = []
+        for tick in range(start, target + 1):
+            bucket = self._buckets[tick % len(self._buckets)]
+            for key in [key for key in bucket if self._due[key] <= target]:
+                bucket.discard(key)
+                del self._due[key]
+                expired.append(key)
+        self._now = max(self._now, target)
+        if self._due:
+            self._timer = self.loop.call_later(self.tick, self._advance)
+        if expired:
+            self.stats['expired'] += len(expired)
+            self._expire(expired)
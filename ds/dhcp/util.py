@@ -1,5 +1,7 @@
 import binascii
+import ipaddress
 from collections import defaultdict
+from functools import lru_cache
 
 
 def mac_to_string(addr_bytes):
@@ -9,3 +11,29 @@ def mac_to_string(addr_bytes):
 _cleanup_table = defaultdict(lambda: None, {ord(c): c for c in '0123456789abcdefABCDEF'})
 def mac_to_bytes(addr_string):
     return binascii.unhexlify(addr_string.translate(_cleanup_table))
+
+
+def mac_to_int(addr_string):
+    return int.from_bytes(mac_to_bytes(addr_string), 'big')
+
+
+def int_to_mac(value):
+    return mac_to_string(value.to_bytes(6, 'big'))
+
+
+def circuit_id_text(value):
+    ''' circuit id (Option 82) для описания владельца: печатный UTF-8 как есть, остальное — hex.
+    Двоичные circuit id часты, а NUL в строке PostgreSQL не принимает.
+    '''
+    if not value:
+        return ''
+    try:
+        text = value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.hex()
+    return text if text.isprintable() else value.hex()
+
+
+@lru_cache(maxsize=256)
+def ip_to_int(addr):
+    return int(ipaddress.IPv4Address(addr))
@@ -0,0 +1,122 @@
+''' Выделение свободных адресов профиля по битовой карте занятых адресов.
+
+Карта строится один раз на профиль (и перестраивается не реже чем раз в max_age секунд),
+поиск следующего свободного адреса идёт от подсказки hint, до которой все адреса заняты,
+поэтому в среднем занимает O(1). Выделение сериализуется advisory lock'ом профиля на время
+транзакции, а кандидат проверяется по таблице — карта может отстать от изменений,
+сделанных в обход этого процесса. Выданный адрес помечается в карте только после коммита
+присвоения (mark()), так что откаченная транзакция его не занимает.
+'''
+import time
+import ipaddress
+
+import sqlalchemy as sa
+
+from ds import db
+
+
+class ProfileBitmap:
+    ''' Занятые адреса сети: бит на каждый адрес от network + 1 до broadcast - 1. '''
+    def __init__(self, network):
+        network = ipaddress.IPv4Network(network)
+        self.first = int(network.network_address) + 1
+        self.size = max(0, network.num_addresses - 2)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.hint = 0  # все байты до hint заполнены
+
+    def _offset(self, ip):
+        offset = int(ipaddress.IPv4Address(ip)) - self.first
+        if 0 <= offset < self.size:
+            return offset
+        return None
+
+    def mark(self, ip):
+        offset = self._offset(ip)
+        if offset is not None:
+            self.bits[offset >> 3] |= 1 << (offset & 7)
+
+    def release(self, ip):
+        offset = self._offset(ip)
+        if offset is not None:
+            self.bits[offset >> 3] &= ~(1 << (offset & 7)) & 0xff
+            self.hint = min(self.hint, offset >> 3)
+
+    def next_free(self):
+        bits = self.bits
+        index = self.hint
+        while index < len(bits) and bits[index] == 0xff:
+            index += 1
+        self.hint = index
+        if index == len(bits):
+            return None
+        byte = bits[index]
+        bit = 0
+        while byte & (1 << bit):
+            bit += 1
+        offset = (index << 3) + bit
+        if offset >= self.size:
+            return None
+        return ipaddress.IPv4Address(self.first + offset)
+
+
+class AddressAllocator:
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._bitmaps = {}  # id профиля -> (время построения, ProfileBitmap)
+
+    async def _bitmap(self, conn, profile_id):
+        entry = self._bitmaps.get(profile_id)
+        if entry is not None and time.monotonic() - entry[0] < self.max_age:
+            return entry[1]
+        network_addr = await conn.scalar(
+            sa.select([db.profile.c.network_addr]).where(db.profile.c.id == profile_id)
+        )
+        if network_addr is None:
+            return None
+        bitmap = ProfileBitmap(network_addr)
+        items = await conn.execute(
+            sa.select([db.owner.c.ip_addr]).
+            where(db.owner.c.profile_id == profile_id).
+            where(db.owner.c.ip_addr != None)
+        )
+        async for item in items:
+            bitmap.mark(item.ip_addr)
+        self._bitmaps[profile_id] = time.monotonic(), bitmap
+        return bitmap
+
+    async def allocate(self, conn, profile_id):
+        ''' Возвращает свободный адрес профиля или None, если свободных нет.
+        Вызывается внутри транзакции, в которой адрес будет присвоен; после её коммита
+        адрес нужно пометить через mark().
+        '''
+        await conn.execute(sa.select([sa.func.pg_advisory_xact_lock(db.ADDRESS_LOCK_CLASS, profile_id)]))
+        bitmap = await self._bitmap(conn, profile_id)
+        if bitmap is None:
+            return None
+        while True:
+            ip_addr = bitmap.next_free()
+            if ip_addr is None:
+                return None
+            taken = await conn.scalar(
+                sa.select([db.owner.c.id]).
+                where(db.owner.c.profile_id == profile_id).
+                where(db.owner.c.ip_addr == str(ip_addr))
+            )
+            if taken is None:
+                return ip_addr
+            # адрес занят в обход карты
+            bitmap.mark(ip_addr)
+
+    def mark(self, profile_id, ip_addr):
+        ''' Помечает адрес занятым; вызывается после коммита транзакции, присвоившей его. '''
+        entry = self._bitmaps.get(profile_id)
+        if entry is not None and ip_addr is not None:
+            entry[1].mark(ip_addr)
+
+    def release(self, profile_id, ip_addr):
+        entry = self._bitmaps.get(profile_id)
+        if entry is not None and ip_addr is not None:
+            entry[1].release(ip_addr)
+
+    def invalidate(self, profile_id):
+        self._bitmaps.pop(profile_id, None)
@@ -2,6 +2,7 @@ import ipaddress
 
 from wtforms import Form
 from wtforms import StringField
+from wtforms import SelectField
 from wtforms import TextAreaField
 from wtforms import validators
 from wtforms import ValidationError
@@ -34,6 +35,26 @@ def validate_ip_list(form, field):
         raise ValidationError(str(e))
 
 
+def mac_prefix_range(prefix):
+    ''' Первый и последний MAC с заданным префиксом: '00:1a:2b' -> ('00:1a:2b:00:00:00', '00:1a:2b:ff:ff:ff'). '''
+    digits = prefix.lower()
+    for sep in ':-.':
+        digits = digits.replace(sep, '')
+    if not digits or len(digits) > 12 or any(c not in '0123456789abcdef' for c in digits):
+        raise ValueError('invalid MAC prefix: {}'.format(prefix))
+
+    def fmt(value):
+        return ':'.join('{:02x}'.format(b) for b in int(value, 16).to_bytes(6, 'big'))
+    return fmt(digits.ljust(12, '0')), fmt(digits.ljust(12, 'f'))
+
+
+def validate_mac_prefix(form, field):
+    try:
+        mac_prefix_range(field.data)
+    except ValueError as e:
+        raise ValidationError(str(e))
+
+
 def filter_ip_list(ip_list):
     if not ip_list:
         return ''
@@ -55,3 +76,11 @@ class ProfileEditForm(Form):
 
 class AssignedItemEditForm(Form):
     description = TextAreaField('Описание')
+
+
+class OwnerFilterForm(Form):
+    profile_id = SelectField('Профиль', choices=[('', 'Все')])
+    mac = StringField('MAC (начало)', [validators.Optional(), validate_mac_prefix])
+    ip_from = StringField('IP с', [validators.Optional(), validate_ip_address])
+    ip_to = StringField('IP по', [validators.Optional(), validate_ip_address])
+    description = StringField('Описание содержит')
@@ -10,6 +10,7 @@ import aiohttp_jinja2
 import jinja2
 
 from . import urls
+from .allocator import AddressAllocator
 
 
 def root_package_name():
@@ -42,6 +43,7 @@ class WebServer:
         app = web.Application(middlewares=middlewares)
         app.ioloop = loop
         app.db = db
+        app.allocator = AddressAllocator()
 
         aiohttp_jinja2.setup(app,
             loader=jinja2.FileSystemLoader(root_package_path('web/templates')))
@@ -9,7 +9,10 @@ def configure(add):
     add('*',    '/profile/{id}/delete', views.profile_delete)
     add('GET',  '/staging/', views.staging_list)
     add('GET',  '/staging/{id}/assign-ip', views.staging_assign_ip)
+    add('POST', '/staging/assign-all', views.staging_assign_all)
     add('GET',  '/staging/{id}/delete', views.staging_delete)
     add('GET',  '/assigned/', views.assigned_list)
     add('GET',  '/assigned/{id}/delete', views.assigned_delete)
     add('*',    '/assigned/{id}/edit', views.assigned_edit)
+    add('*',    '/transfer/', views.transfer_import)
+    add('GET',  '/transfer/{kind:profiles|owners}.{fmt:ndjson|csv}', views.transfer_export)
@@ -1,4 +1,7 @@
+import io
 import datetime
+import tempfile
+from urllib.parse import urlencode
 
 from aiohttp import web
 from aiohttp_jinja2 import template
@@ -7,6 +10,7 @@ from sqlalchemy.dialects import postgresql as pg
 import psycopg2
 
 from ds import db
+from ds.db import transfer
 from . import forms
 
 
@@ -20,20 +24,101 @@ async def profile_list(request):
     async with request.app.db.acquire() as conn:
         items = await (await conn.execute(
             sa.select([
-                db.profile, 'ips_used',
+                db.profile,
+                sa.func.coalesce(db.profile_usage.c.assigned, 0).label('ips_assigned'),
+                sa.func.coalesce(db.profile_usage.c.staged, 0).label('ips_staged'),
                 (sa.func.broadcast(db.profile.c.network_addr) - db.profile.c.network_addr - 2).label('ips_total')
             ]).
             select_from(
                 db.profile.
-                join(sa.select([
-                    db.owner.c.profile_id, sa.func.count(db.owner.c.id).label('ips_used')
-                ]).group_by(db.owner.c.profile_id).alias('cnts'))
+                outerjoin(db.profile_usage)
             ).
             order_by(db.profile.c.name)
         )).fetchall()
     return {'items': items}
 
 
+PAGE_SIZE = 100
+CURSOR_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _encode_cursor(date, item_id):
+    # микросекунды, а не строка даты: курсор должен точно совпадать со значением в БД
+    return '{}.{}'.format((date - CURSOR_EPOCH) // datetime.timedelta(microseconds=1), item_id)
+
+
+def _decode_cursor(cursor):
+    micros, item_id = cursor.split('.')
+    return CURSOR_EPOCH + datetime.timedelta(microseconds=int(micros)), int(item_id)
+
+
+def _owner_filters(form):
+    conds = []
+    if form.profile_id.data:
+        conds.append(db.owner.c.profile_id == int(form.profile_id.data))
+    if form.mac.data:
+        mac_first, mac_last = forms.mac_prefix_range(form.mac.data)
+        conds.append(db.owner.c.mac_addr.between(mac_first, mac_last))
+    if form.ip_from.data:
+        conds.append(db.owner.c.ip_addr >= sa.cast(form.ip_from.data, pg.INET))
+    if form.ip_to.data:
+        conds.append(db.owner.c.ip_addr <= sa.cast(form.ip_to.data, pg.INET))
+    if form.description.data:
+        pattern = form.description.data.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conds.append(db.owner.c.description.ilike('%' + pattern + '%'))
+    return conds
+
+
+async def _owner_page(request, conn, where, date_column):
+    ''' Страница списка MAC по ключу (дата, id) в порядке убывания.
+
+    Следующая страница начинается строго после курсора ?after=, поэтому запрос читает
+    не больше PAGE_SIZE + 1 строк по индексу независимо от размера таблицы.
+    '''
+    form = forms.OwnerFilterForm(request.query)
+    profiles = await (await conn.execute(
+        sa.select([db.profile.c.id, db.profile.c.name]).order_by(db.profile.c.name)
+    )).fetchall()
+    form.profile_id.choices = [('', 'Все')] + [(str(p.id), p.name) for p in profiles]
+
+    query = (
+        sa.select([
+            db.owner,
+            db.profile.c.name.label('profile_name'),
+            db.profile.c.relay_ip,
+        ]).
+        select_from(
+            db.owner.
+            join(db.profile)
+        ).
+        where(where)
+    )
+    if form.validate():
+        for cond in _owner_filters(form):
+            query = query.where(cond)
+    cursor = request.query.get('after')
+    if cursor:
+        try:
+            query = query.where(sa.tuple_(date_column, db.owner.c.id) < sa.tuple_(*_decode_cursor(cursor)))
+        except ValueError:
+            cursor = None
+    query = query.order_by(sa.desc(date_column), sa.desc(db.owner.c.id)).limit(PAGE_SIZE + 1)
+    items = await (await conn.execute(query)).fetchall()
+
+    params = {key: value for key, value in request.query.items() if key != 'after' and value}
+    next_url = None
+    if len(items) > PAGE_SIZE:
+        items = items[:PAGE_SIZE]
+        last = items[-1]
+        next_url = '?' + urlencode(dict(params, after=_encode_cursor(last[date_column.name], last.id)))
+    return {
+        'items': items,
+        'form': form,
+        'first_url': ('?' + urlencode(params)) if cursor else None,
+        'next_url': next_url,
+    }
+
+
 def _cast_str_to_inet_arr(ip_list_str):
     return sa.cast(map(str, forms.str_to_ip_list(ip_list_str)), pg.ARRAY(pg.INET))
 
@@ -55,14 +140,16 @@ async def profile_edit(request):
                 params['dns_ips'] = _cast_str_to_inet_arr(params['dns_ips'])
                 params['ntp_ips'] = _cast_str_to_inet_arr(params['ntp_ips'])
                 if item_id is None:
-                    await conn.execute(tbl.insert().values(params))
+                    # без уведомления DHCP сервер не знает релей нового профиля и игнорирует его клиентов
+                    new_id = await conn.scalar(tbl.insert().values(params).returning(tbl.c.id))
+                    await db.notify_control(conn, 'RELOAD_PROFILE', [new_id])
                 else:
+                    params['modify_date'] = sa.func.now()
                     await conn.execute(
                         tbl.update().values(params).where(tbl.c.id == item_id)
                     )
-                    await conn.execute(
-                        sa.select([sa.func.pg_notify('dhcp_control', 'RELOAD_PROFILE {}'.format(item_id))])
-                    )
+                    await db.notify_control(conn, 'RELOAD_PROFILE', [item_id])
+                    request.app.allocator.invalidate(int(item_id))
 
                 return web.HTTPFound('/profile/')
 
@@ -73,27 +160,30 @@ async def profile_delete(request):
     tbl = db.profile
     item_id = request.match_info.get('id')
     async with request.app.db.acquire() as conn:
-        await conn.execute(tbl.delete().where(tbl.c.id == item_id))
+        async with conn.begin():
+            await conn.execute(tbl.delete().where(tbl.c.id == item_id))
+            await db.notify_control(conn, 'RELOAD_PROFILE', [item_id])
+        request.app.allocator.invalidate(int(item_id))
         return web.HTTPFound('/profile/')
 
 
 @template('staging_list.jinja2')
 async def staging_list(request):
     async with request.app.db.acquire() as conn:
-        items = await (await conn.execute(
+        page = await _owner_page(request, conn, db.owner.c.ip_addr == None, db.owner.c.create_date)
+        # для массового назначения нужны все профили с ожидающими MAC, а не только текущей страницы
+        page['staged_profiles'] = await (await conn.execute(
             sa.select([
-                db.owner,
-                db.profile.c.name.label('profile_name'),
-                db.profile.c.relay_ip,
+                db.profile.c.id, db.profile.c.name, db.profile_usage.c.staged,
             ]).
             select_from(
-                db.owner.
-                join(db.profile)
+                db.profile.
+                join(db.profile_usage)
             ).
-            where(db.owner.c.ip_addr == None).
-            order_by(sa.desc(db.owner.c.create_date))
+            where(db.profile_usage.c.staged > 0).
+            order_by(db.profile.c.name)
         )).fetchall()
-        return {'items': items}
+        return page
 
 
 async def staging_assign_ip(request):
@@ -103,34 +193,37 @@ async def staging_assign_ip(request):
             profile_id = await conn.scalar(
                 sa.select([db.owner.c.profile_id]).where(db.owner.c.id == item_id)
             )
-            gen = sa.select([
-                (sa.cast('0.0.0.0', pg.INET) + sa.func.generate_series(
-                    sa.cast(db.profile.c.network_addr, pg.INET) - '0.0.0.0' + 1,
-                    sa.func.broadcast(db.profile.c.network_addr) - '0.0.0.0' - 1
-                )).label('ip_addr')
-            ]).\
-                select_from(db.profile.join(db.owner)). \
-                where(db.profile.c.id == profile_id)
-            sel = sa.select([db.owner.c.ip_addr]). \
-                where(db.owner.c.profile_id == profile_id). \
-                where(db.owner.c.ip_addr != None)
-            ip_addr = gen.except_(sel).order_by('ip_addr').limit(1)
-            await conn.execute(
-                db.owner.update().values(
-                    ip_addr=ip_addr,
-                    modify_date=sa.func.now()
-                ).
-                where(db.owner.c.id == item_id)
-            )
-            await conn.execute(
-                sa.select([sa.func.pg_notify('dhcp_control', 'RELOAD_ITEM {}'.format(item_id))])
-            )
+            ip_addr = await request.app.allocator.allocate(conn, profile_id)
+            if ip_addr is not None:
+                await conn.execute(
+                    db.owner.update().values(
+                        ip_addr=str(ip_addr),
+                        modify_date=sa.func.now()
+                    ).
+                    where(db.owner.c.id == item_id)
+                )
+                await db.notify_control(conn, 'RELOAD_ITEMS', [item_id])
+        request.app.allocator.mark(profile_id, ip_addr)
 
         if 'edit' in request.rel_url.query:
             return web.HTTPFound('/assigned/{}/edit?redirect=/staging/'.format(item_id))
         return web.HTTPFound('/staging/')
 
 
+async def staging_assign_all(request):
+    data = await request.post()
+    try:
+        profile_id = int(data['profile_id'])
+        ids = [int(item_id) for item_id in data.getall('id', [])]
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest()
+    async with request.app.db.acquire() as conn:
+        async with conn.begin():
+            await db.assign_staging(conn, profile_id, ids)
+    request.app.allocator.invalidate(profile_id)
+    return web.HTTPFound('/staging/')
+
+
 async def staging_delete(request):
     tbl = db.owner
     item_id = request.match_info.get('id')
@@ -141,29 +234,14 @@ async def staging_delete(request):
                 where(tbl.c.id == item_id)
             )
             await conn.execute(tbl.delete().where(tbl.c.id == item_id))
-            await conn.execute(
-                sa.select([sa.func.pg_notify('dhcp_control', 'REMOVE_STAGING {}'.format(mac_addr))])
-            )
+            await db.notify_control(conn, 'REMOVE_STAGING', [mac_addr])
         return web.HTTPFound('/staging/')
 
 
 @template('assigned_list.jinja2')
 async def assigned_list(request):
     async with request.app.db.acquire() as conn:
-        items = await (await conn.execute(
-            sa.select([
-                db.owner,
-                db.profile.c.name.label('profile_name'),
-                db.profile.c.relay_ip,
-            ]).
-            select_from(
-                db.owner.
-                join(db.profile)
-            ).
-            where(db.owner.c.ip_addr != None).
-            order_by(sa.desc(db.owner.c.lease_date))
-        )).fetchall()
-        return {'items': items}
+        return await _owner_page(request, conn, db.owner.c.ip_addr != None, db.owner.c.lease_date)
 
 
 @template('assigned_edit.jinja2')
@@ -189,6 +267,7 @@ async def assigned_edit(request):
             await conn.execute(
                 db.owner.update().values(params).where(db.owner.c.id == item_id)
             )
+            request.app.allocator.invalidate(item.profile_id)
             if 'redirect' in request.rel_url.query:
                 return web.HTTPFound(request.rel_url.query['redirect'])
             return web.HTTPFound('/assigned/')
@@ -201,12 +280,86 @@ async def assigned_delete(request):
     item_id = request.match_info.get('id')
     async with request.app.db.acquire() as conn:
         async with conn.begin():
-            mac_addr = await conn.scalar(
-                sa.select([tbl.c.mac_addr]).
+            item = await (await conn.execute(
+                sa.select([tbl.c.mac_addr, tbl.c.ip_addr, tbl.c.profile_id]).
                 where(tbl.c.id == item_id)
-            )
+            )).fetchone()
+            if item is None:
+                return web.HTTPFound('/assigned/')
             await conn.execute(tbl.delete().where(tbl.c.id == item_id))
-            await conn.execute(
-                sa.select([sa.func.pg_notify('dhcp_control', 'REMOVE_ACTIVE {}'.format(mac_addr))])
-            )
+            await db.notify_control(conn, 'REMOVE_ACTIVE', [item.mac_addr])
+        request.app.allocator.release(item.profile_id, item.ip_addr)
         return web.HTTPFound('/assigned/')
+
+
+async def transfer_export(request):
+    kind = request.match_info['kind']
+    fmt = request.match_info['fmt']
+    resp = web.StreamResponse(headers={
+        'Content-Disposition': 'attachment; filename="{}.{}"'.format(kind, fmt),
+    })
+    resp.content_type = transfer.CONTENT_TYPES[fmt]
+    resp.charset = 'utf-8'
+    await resp.prepare(request)
+
+    async def write(text):
+        resp.write(text.encode('utf-8'))
+        await resp.drain()
+
+    async with request.app.db.acquire() as conn:
+        await transfer.export(conn, kind, fmt, write)
+    await resp.write_eof()
+    return resp
+
+
+async def _spool_upload(request):
+    ''' Читает multipart форму; файл сохраняется во временный файл, а не в память. '''
+    fields = {}
+    upload = tempfile.TemporaryFile()
+    reader = await request.multipart()
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+        if part.filename is None:
+            fields[part.name] = await part.text()
+            continue
+        while True:
+            chunk = await part.read_chunk()
+            if not chunk:
+                break
+            upload.write(chunk)
+    upload.seek(0)
+    return fields, upload
+
+
+@template('transfer.jinja2')
+async def transfer_import(request):
+    result = {'kinds': sorted(transfer.FIELDS), 'formats': transfer.FORMATS}
+    if request.method != 'POST':
+        return result
+    fields, upload = await _spool_upload(request)
+    kind = fields.get('kind')
+    fmt = fields.get('format')
+    if kind not in transfer.FIELDS or fmt not in transfer.FORMATS:
+        raise web.HTTPBadRequest()
+    lines = io.TextIOWrapper(upload, encoding='utf-8', newline='')
+    try:
+        async with request.app.db.acquire() as conn:
+            async with conn.begin():
+                since = await conn.scalar(sa.select([sa.func.now()]))
+                await conn.execute(transfer.staging_table_sql(kind))
+                loaded = await transfer.insert_records(conn, kind, transfer.read_records(fmt, kind, lines))
+                merged = await (await conn.execute(transfer.merge_sql(kind))).fetchall()
+                await conn.execute(db.resync_notification(since))
+    except (transfer.TransferError, UnicodeDecodeError, psycopg2.Error) as e:
+        result['error'] = str(e)
+        return result
+    finally:
+        lines.close()
+    for row in merged:
+        request.app.allocator.invalidate(row.profile_id)
+    total = sum(row.merged for row in merged)
+    result['message'] = 'Загружено записей: {}, перенесено: {} (профилей: {}), пропущено: {}'.format(
+        loaded, total, len(merged), loaded - total)
+    return result
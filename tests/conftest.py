@@ -0,0 +1,71 @@
+''' Подмены соединений PostgreSQL для тестов DHCP сервера.
+
+Сервер написан под asyncio с аргументом loop= (удалён в Python 3.10); на версиях,
+где его нет, тесты пропускаются с явной причиной.
+'''
+import sys
+import asyncio
+
+import pytest
+
+
+def _asyncio_accepts_loop():
+    try:
+        asyncio.Queue(loop=None)
+    except TypeError:
+        return False
+    return True
+
+
+def pytest_collection_modifyitems(config, items):
+    if _asyncio_accepts_loop():
+        return
+    skip = pytest.mark.skip(reason='asyncio on Python {}.{} does not accept loop='.format(*sys.version_info[:2]))
+    for item in items:
+        item.add_marker(skip)
+
+
+class Row(dict):
+    ''' Строка результата: доступ и по ключу, и по атрибуту, как у RowProxy. '''
+    __getattr__ = dict.__getitem__
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    async def fetchall(self):
+        return self.rows
+
+    def __aiter__(self):
+        self._iter = iter(self.rows)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class IdleEngine:
+    ''' Пул, из которого фоновые очереди БД сервера так и не получают соединения:
+    тесты передают соединение в обработчики сами.
+    '''
+    maxsize = None
+
+    async def acquire(self):
+        await asyncio.Event().wait()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    pending = [task for task in asyncio.all_tasks(loop) if not task.done()]
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, loop=loop, return_exceptions=True))
+    loop.close()
+    asyncio.set_event_loop(None)
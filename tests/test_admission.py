@@ -0,0 +1,76 @@
+import ipaddress
+from datetime import timedelta
+
+import pytest
+
+pytest.importorskip('aiopg')
+pytest.importorskip('sqlalchemy')
+
+from ds.dhcp.admission import Admission
+from ds.dhcp.cache import Profile
+from ds.dhcp.proto.dhcpmsg import MessageType
+from ds.dhcp.proto.packet import Packet
+from ds.dhcp.proto.packet import PacketView
+from ds.dhcp.server import DHCPServer
+from ds.dhcp.server import DBTask
+from ds.dhcp.util import ip_to_int
+from ds.dhcp.util import mac_to_int
+
+from conftest import IdleEngine
+
+
+RELAY_IP = '10.0.0.1'
+KNOWN_MAC = '00:00:00:00:00:0a'
+NEW_MAC = '00:00:00:00:00:0b'
+
+
+class FakeListener:
+    server_addr = '10.0.0.100'
+
+
+@pytest.fixture
+def server(loop):
+    server = DHCPServer(IdleEngine(), None, '10.0.0.100', loop=loop, stats_interval=0,
+                        admission=Admission(max_backlog=2))
+    server.maps.set_profile(Profile(
+        1, ipaddress.IPv4Address(RELAY_IP), ipaddress.IPv4Network('10.1.0.0/16'), timedelta(hours=1)))
+    server.maps.set(mac_to_int(KNOWN_MAC), 7, ip_to_int('10.1.0.7'), 1)
+    return server
+
+
+def request(mac, message_type=MessageType.DISCOVER):
+    pkt = Packet(message_type=message_type)
+    pkt.chaddr = mac
+    pkt.hops = 1
+    pkt.giaddr = RELAY_IP
+    return PacketView(pkt.pack())
+
+
+def handle(server, mac, message_type=MessageType.DISCOVER):
+    return server.handle_request_nowait(request(mac, message_type), (RELAY_IP, 67), FakeListener())
+
+
+def fill_backlog(server, count):
+    for owner_id in range(count):
+        server.db_lanes[0].queue.put_nowait((DBTask.UPDATE_LEASE, {owner_id: 0}))
+
+
+def test_new_mac_is_deferred_below_backlog_limit(server):
+    fill_backlog(server, 1)
+
+    assert handle(server, NEW_MAC) is server.DEFER
+    assert server.admission.stats['shed_backlog'] == 0
+
+
+def test_only_db_writes_are_shed_when_backlog_is_full(server):
+    fill_backlog(server, 1)
+    server.staging_batchers[0].items[mac_to_int(NEW_MAC)] = (1, '')
+    assert server.db_backlog() == 2
+
+    assert handle(server, NEW_MAC) is None
+    assert server.admission.stats['shed_backlog'] == 1
+
+    # известный MAC получает OFFER из кэша даже при полной очереди
+    offer = handle(server, KNOWN_MAC)
+    assert offer is not None and offer is not server.DEFER
+    assert server.admission.stats['shed_backlog'] == 1
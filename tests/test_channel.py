@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiopg')
+pytest.importorskip('sqlalchemy')
+
+from ds.dhcp import server
+from ds.dhcp.server import DBChannelListener
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def execute(self, sql):
+        if self.conn.broken:
+            raise ConnectionError('server closed the connection unexpectedly')
+        self.conn.executed.append(sql)
+
+
+class FakeConnection:
+    ''' Соединение aiopg: очередь уведомлений и курсор, который можно «оборвать». '''
+    def __init__(self):
+        self.notifies = asyncio.Queue()
+        self.executed = []
+        self.broken = False
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    ''' Подменяет aiopg.connect; в outcomes кладутся соединения и исключения по порядку попыток. '''
+    outcomes = []
+
+    async def fake_connect(**params):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(server.aiopg, 'connect', fake_connect)
+    return outcomes
+
+
+@pytest.fixture
+def listener(loop):
+    listener = DBChannelListener({'host': 'db'}, 'dhcp_control', keepalive=0.01, loop=loop)
+    listener.RECONNECT_DELAY = 0.01
+    yield listener
+    loop.run_until_complete(listener.stop())
+
+
+def next_message(loop, listener):
+    return loop.run_until_complete(asyncio.wait_for(listener.queue.get(), 1, loop=loop))
+
+
+def test_notifications_are_forwarded(loop, connect, listener):
+    conn = FakeConnection()
+    connect.append(conn)
+    loop.run_until_complete(listener.start())
+
+    conn.notifies.put_nowait('RELOAD_ITEMS 1,2')
+
+    assert next_message(loop, listener) == 'RELOAD_ITEMS 1,2'
+    assert conn.executed[0] == 'LISTEN dhcp_control'
+
+
+def test_lost_connection_is_reconnected_with_marker(loop, connect, listener):
+    first, second = FakeConnection(), FakeConnection()
+    connect.extend([first, OSError('connection refused'), second])
+    loop.run_until_complete(listener.start())
+
+    first.broken = True
+
+    assert next_message(loop, listener) is listener.RECONNECTED
+    assert listener.reconnects == 1
+    assert first.closed
+    assert second.executed[0] == 'LISTEN dhcp_control'
+
+    second.notifies.put_nowait('RELOAD_PROFILE 3')
+    assert next_message(loop, listener) == 'RELOAD_PROFILE 3'
+
+
+def test_stop_closes_queue(loop, connect, listener):
+    connect.append(FakeConnection())
+    loop.run_until_complete(listener.start())
+    loop.run_until_complete(listener.stop())
+
+    assert next_message(loop, listener) is None
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+pytest.importorskip('aiopg')
+pytest.importorskip('sqlalchemy')
+
+from ds.dhcp.server import DHCPServer
+from ds.dhcp.util import mac_to_int
+
+from conftest import Row
+from conftest import FakeResult
+from conftest import IdleEngine
+
+
+class ForeignKeyViolation(Exception):
+    pass
+
+
+class InFailedSqlTransaction(Exception):
+    pass
+
+
+class FakeTransaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def __aenter__(self):
+        self.conn.levels.append((dict(self.conn.leases), dict(self.conn.owners)))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        state = self.conn.levels.pop()
+        if exc_type is not None or (self.conn.aborted and not self.conn.levels):
+            # откат транзакции или к точке сохранения снимает и состояние ошибки
+            self.conn.leases, self.conn.owners = state
+            self.conn.aborted = False
+
+
+class FakeConnection:
+    ''' Соединение с транзакциями как в PostgreSQL: после ошибки внутри транзакции
+    все запросы отвергаются до отката (или отката к точке сохранения).
+    '''
+    def __init__(self, profile_ids):
+        self.profile_ids = set(profile_ids)
+        self.leases = {}  # owner id -> дата аренды
+        self.owners = {}  # MAC -> id профиля
+        self.levels = []
+        self.aborted = False
+        self.closed = False
+
+    def begin(self):
+        return FakeTransaction(self)
+
+    begin_nested = begin
+
+    async def execute(self, query, **params):
+        if self.aborted:
+            raise InFailedSqlTransaction('current transaction is aborted')
+        if query is DHCPServer.sql_update_leases:
+            for owner_id, date in zip(params['ids'], params['dates']):
+                self.leases[owner_id] = max(date, self.leases.get(owner_id, date))
+            return FakeResult([])
+        if query is DHCPServer.sql_insert_staging:
+            rows = []
+            for mac, profile_id in zip(params['macs'], params['profile_ids']):
+                if profile_id not in self.profile_ids:
+                    self.aborted = bool(self.levels)
+                    raise ForeignKeyViolation('owner_profile_id_fkey')
+                if mac not in self.owners:
+                    self.owners[mac] = profile_id
+                    rows.append(Row(mac_addr=mac))
+            return FakeResult(rows)
+        # перечитывание уже существующих MAC
+        return FakeResult([])
+
+
+class ReplayEngine:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self.conn
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+@pytest.fixture
+def server(loop, tmp_path):
+    server = DHCPServer(IdleEngine(), None, '10.0.0.100', loop=loop, stats_interval=0,
+                        journal_dir=str(tmp_path), journal_replay_interval=3600)
+    # очереди БД берут соединения из IdleEngine и простаивают, проигрывание идёт через подменённый пул
+    loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    return server
+
+
+GOOD_MACS = ['00:00:00:00:00:0a', '00:00:00:00:00:0b']
+BAD_MAC = '00:00:00:00:00:0c'
+
+
+def test_bad_staging_row_does_not_lose_segment(loop, server, tmp_path):
+    conn = FakeConnection(profile_ids=[1])
+    server.db = ReplayEngine(conn)
+    now = time.time()
+    server.journal.append('lease', [[1, now - 10], [2, now - 5]])
+    server.journal.append('staging', [[mac_to_int(mac), 1, ''] for mac in GOOD_MACS])
+    # профиль 2 удалён, пока сегмент ждал проигрывания
+    server.journal.append('staging', [[mac_to_int(BAD_MAC), 2, '']])
+
+    loop.run_until_complete(server.db_replay_journal())
+
+    assert sorted(conn.leases) == [1, 2]
+    assert sorted(conn.owners) == GOOD_MACS
+    assert server.counters['staging_rejected'] == 1
+    assert server.counters['journal_replay_failed'] == 0
+    assert server.journal.sealed() == []
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.failed')]
@@ -0,0 +1,192 @@
+import ipaddress
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+import pytest
+
+pytest.importorskip('aiopg')
+pytest.importorskip('sqlalchemy')
+
+from ds.dhcp.server import DHCPServer
+from ds.dhcp.server import DBTask
+from ds.dhcp.cache import Profile
+from ds.dhcp.util import mac_to_int
+
+from conftest import Row
+from conftest import FakeResult
+from conftest import IdleEngine
+
+
+NOW = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+RELAY_IP = ipaddress.IPv4Address('10.0.0.1')
+
+
+class FakeDB:
+    ''' Таблицы profile, owner и owner_deleted в памяти; запросы различаются по тексту SQL,
+    условие "дата > :param" применяется к строкам.
+    '''
+    def __init__(self):
+        self.now = NOW
+        self.profiles = []
+        self.owners = []
+        self.tombstones = []
+        self.tombstones_since = None
+        self.queries = []
+        self.closed = False
+
+    async def scalar(self, query):
+        assert str(query).startswith('SELECT now()')
+        return self.now
+
+    async def execute(self, query):
+        sql = str(query)
+        self.queries.append(sql)
+        since = next(iter(query.compile().params.values()), None)
+        if sql.startswith('DELETE FROM owner_deleted'):
+            rows = []
+        elif 'FROM owner_deleted' in sql:
+            self.tombstones_since = since
+            rows = [row for row in self.tombstones if row.delete_date > since]
+        elif 'JOIN profile' in sql:
+            rows = sorted((row for row in self.owners if row.modify_date > since), key=lambda row: row.modify_date)
+        elif sql.startswith('SELECT owner.id'):
+            rows = [Row(id=row.id) for row in self.owners if row.ip_addr is not None]
+        elif sql.startswith('SELECT owner.mac_addr'):
+            rows = [Row(mac_addr=row.mac_addr) for row in self.owners if row.ip_addr is None]
+        elif sql.startswith('SELECT profile.id \nFROM profile'):
+            rows = [Row(id=row.id) for row in self.profiles]
+        else:
+            rows = [row for row in self.profiles if row.modify_date > since]
+        return FakeResult(rows)
+
+    def add_profile(self, profile_id, modify_date=NOW - timedelta(days=1)):
+        self.profiles.append(Row(
+            id=profile_id, relay_ip=RELAY_IP, router_ip=None, network_addr=ipaddress.IPv4Network('10.1.0.0/16'),
+            lease_time=timedelta(hours=1), dns_ips=None, ntp_ips=None, modify_date=modify_date))
+
+    def add_owner(self, owner_id, mac, ip, modify_date, profile_id=1):
+        profile = next(row for row in self.profiles if row.id == profile_id)
+        self.owners.append(Row(
+            relay_ip=profile.relay_ip, router_ip=profile.router_ip, network_addr=profile.network_addr,
+            lease_time=profile.lease_time, dns_ips=profile.dns_ips, ntp_ips=profile.ntp_ips,
+            profile_id=profile_id, mac_addr=mac, ip_addr=ipaddress.IPv4Address(ip) if ip else None,
+            lease_date=modify_date, id=owner_id, modify_date=modify_date,
+            profile_modify_date=profile.modify_date))
+
+    def delete_owner(self, owner_id, delete_date):
+        row = next(row for row in self.owners if row.id == owner_id)
+        self.owners.remove(row)
+        self.tombstones.append(Row(
+            owner_id=row.id, mac_addr=row.mac_addr, delete_date=delete_date))
+
+
+@pytest.fixture
+def fake_db():
+    fake_db = FakeDB()
+    fake_db.add_profile(1)
+    return fake_db
+
+
+@pytest.fixture
+def server(loop, fake_db):
+    server = DHCPServer(IdleEngine(), None, '10.0.0.100', loop=loop, stats_interval=0)
+    server.maps.set_profile(Profile.from_row(fake_db.profiles[0]))
+    return server
+
+
+def cache_owner(server, fake_db, owner_id, mac, ip, modify_date):
+    fake_db.add_owner(owner_id, mac, ip, modify_date)
+    server._update_item(fake_db.owners[-1])
+
+
+MAC_A = '00:00:00:00:00:0a'
+MAC_B = '00:00:00:00:00:0b'
+MAC_C = '00:00:00:00:00:0c'
+
+
+def test_deletions_are_read_from_tombstones(loop, server, fake_db):
+    cache_owner(server, fake_db, 1, MAC_A, '10.1.0.1', NOW - timedelta(hours=2))
+    cache_owner(server, fake_db, 2, MAC_B, '10.1.0.2', NOW - timedelta(hours=2))
+    cache_owner(server, fake_db, 3, MAC_C, None, NOW - timedelta(hours=2))
+    server.tombstone_mark = (NOW - timedelta(hours=1)).timestamp()
+    fake_db.delete_owner(1, NOW - timedelta(minutes=30))
+    fake_db.delete_owner(3, NOW - timedelta(minutes=30))
+
+    loop.run_until_complete(server._db_load_changes(fake_db))
+
+    assert server.maps.get(mac_to_int(MAC_A)) is None
+    assert server.maps.get(mac_to_int(MAC_B)) is not None
+    assert mac_to_int(MAC_C) not in server.maps_staging
+    assert server.counters['full_diffs'] == 0
+    assert not any(sql.startswith('SELECT owner.id') for sql in fake_db.queries)
+    assert server.tombstone_mark == NOW.timestamp()
+
+
+def test_tombstones_are_read_since_last_check_not_watermark(loop, server, fake_db):
+    # изменений давно не было, watermark отстал, а удаления идут
+    cache_owner(server, fake_db, 1, MAC_A, '10.1.0.1', NOW - timedelta(days=3))
+    mark = NOW - timedelta(minutes=10)
+    server.tombstone_mark = mark.timestamp()
+    fake_db.delete_owner(1, NOW - timedelta(minutes=5))
+
+    loop.run_until_complete(server._db_load_changes(fake_db))
+
+    assert fake_db.tombstones_since == mark - timedelta(seconds=server.WATERMARK_MARGIN)
+    assert server.maps.get(mac_to_int(MAC_A)) is None
+    assert server.counters['full_diffs'] == 0
+
+
+def test_tombstone_does_not_drop_recreated_owner(loop, server, fake_db):
+    cache_owner(server, fake_db, 1, MAC_A, '10.1.0.1', NOW - timedelta(hours=2))
+    server.tombstone_mark = (NOW - timedelta(hours=1)).timestamp()
+    fake_db.delete_owner(1, NOW - timedelta(minutes=30))
+    fake_db.add_owner(7, MAC_A, '10.1.0.7', NOW - timedelta(minutes=20))
+
+    loop.run_until_complete(server._db_load_changes(fake_db))
+
+    assert server.maps.get(mac_to_int(MAC_A))[0] == 7
+
+
+def test_full_diff_when_tombstones_do_not_cover_the_gap(loop, server, fake_db):
+    cache_owner(server, fake_db, 1, MAC_A, '10.1.0.1', NOW - timedelta(days=30))
+    cache_owner(server, fake_db, 2, MAC_B, '10.1.0.2', NOW - timedelta(days=30))
+    # удаление старше срока хранения owner_deleted: строки о нём уже нет
+    fake_db.owners = [row for row in fake_db.owners if row.id != 1]
+    # кэш из снимка месячной давности
+    server.watermark = (NOW - timedelta(days=30)).timestamp()
+    server.tombstone_mark = None
+
+    loop.run_until_complete(server._db_load_changes(fake_db))
+
+    assert server.maps.get(mac_to_int(MAC_A)) is None
+    assert server.maps.get(mac_to_int(MAC_B)) is not None
+    assert server.counters['full_diffs'] == 1
+    assert server.tombstone_mark == NOW.timestamp()
+
+
+def test_unassigned_owner_moves_to_staging(loop, server, fake_db):
+    cache_owner(server, fake_db, 1, MAC_A, '10.1.0.1', NOW - timedelta(hours=2))
+    server.tombstone_mark = (NOW - timedelta(hours=1)).timestamp()
+    fake_db.owners[-1].update(ip_addr=None, modify_date=NOW - timedelta(minutes=5))
+
+    loop.run_until_complete(server._db_load_changes(fake_db))
+
+    assert server.maps.get(mac_to_int(MAC_A)) is None
+    assert mac_to_int(MAC_A) in server.maps_staging
+
+
+def test_resync_since_reaches_behind_watermark(loop, server, fake_db):
+    cache_owner(server, fake_db, 1, MAC_A, '10.1.0.1', NOW - timedelta(minutes=1))
+    server.tombstone_mark = (NOW - timedelta(minutes=1)).timestamp()
+    # пакетная загрузка пометила строку временем начала своей транзакции
+    imported_at = NOW - timedelta(hours=1)
+    fake_db.add_owner(2, MAC_B, '10.1.0.2', imported_at)
+
+    loop.run_until_complete(server.db_handle_task(fake_db, DBTask.RESYNC, None))
+    assert server.maps.get(mac_to_int(MAC_B)) is None
+
+    loop.run_until_complete(server.db_handle_task(fake_db, DBTask.RESYNC, imported_at.timestamp()))
+    assert server.maps.get(mac_to_int(MAC_B))[0] == 2
+    assert server.counters['resyncs'] == 2
+    assert sum(sql.startswith('DELETE FROM owner_deleted') for sql in fake_db.queries) == 2